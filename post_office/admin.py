@@ -10,7 +10,7 @@ from django.forms import BaseInlineFormSet
 from django.forms.widgets import TextInput
 from django.http.response import (HttpResponse, HttpResponseNotFound,
                                   HttpResponseRedirect)
-from django.template import Context, Template
+from django.template import Context, Engine
 from django.urls import re_path, reverse
 from django.utils.html import format_html
 from django.utils.text import Truncator
@@ -18,8 +18,9 @@ from django.utils.translation import gettext_lazy as _
 
 from .fields import CommaSeparatedEmailField
 from .mail import send
-from .models import STATUS, Attachment, Email, EmailTemplate, Log
+from .models import STATUS, ArchivedEmail, ArchivedLog, Attachment, Email, EmailTemplate, Log
 from .sanitizer import clean_html
+from .template.cache import compiled_templates
 
 
 def get_message_preview(instance):
@@ -78,7 +79,7 @@ class CommaSeparatedEmailWidget(TextInput):
 
 def requeue(modeladmin, request, queryset):
     """An admin action to requeue emails."""
-    queryset.update(status=STATUS.queued)
+    queryset.update(status=STATUS.queued, lease_owner='', lease_expires_at=None)
 
 
 requeue.short_description = 'Requeue selected emails'
@@ -124,12 +125,7 @@ class EmailAdmin(admin.ModelAdmin):
 
     def shortened_subject(self, instance):
         if instance.template:
-            template_cache_key = '_subject_template_' + str(instance.template_id)
-            template = getattr(self, template_cache_key, None)
-            if template is None:
-                # cache compiled template to speed up rendering of list view
-                template = Template(instance.template.subject)
-                setattr(self, template_cache_key, template)
+            template = compiled_templates.get(instance.template, Engine.get_default())[0]
             subject = template.render(Context(instance.context))
         else:
             subject = instance.subject
@@ -216,6 +212,39 @@ class LogAdmin(admin.ModelAdmin):
     list_display = ('date', 'email', 'status', get_message_preview)
 
 
+class ArchivedLogInline(LogInline):
+    model = ArchivedLog
+
+
+class ArchivedEmailAdmin(admin.ModelAdmin):
+    """
+    Archived emails are browsable, but can't be changed.
+    """
+    list_display = ['id', 'to_display', 'subject', 'status', 'last_updated', 'archived']
+    search_fields = ['to', 'subject']
+    date_hierarchy = 'last_updated'
+    inlines = [ArchivedLogInline]
+    list_filter = ['status', 'template__language', 'template__name']
+    fields = ['id', 'message_id', 'from_email', 'to', 'cc', 'bcc', 'priority',
+              ('status', 'scheduled_time'), 'template', 'subject', 'message', 'html_message',
+              ('created', 'last_updated', 'archived')]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('template')
+
+    def to_display(self, instance):
+        return ', '.join(instance.to)
+
+    to_display.short_description = _("To")
+    to_display.admin_order_field = 'to'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 class SubjectField(TextInput):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -318,5 +347,6 @@ class AttachmentAdmin(admin.ModelAdmin):
 
 admin.site.register(Email, EmailAdmin)
 admin.site.register(Log, LogAdmin)
+admin.site.register(ArchivedEmail, ArchivedEmailAdmin)
 admin.site.register(EmailTemplate, EmailTemplateAdmin)
 admin.site.register(Attachment, AttachmentAdmin)
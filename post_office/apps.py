@@ -8,8 +8,12 @@ class PostOfficeConfig(AppConfig):
 
     def ready(self):
         from post_office import tasks
-        from post_office.settings import get_celery_enabled
+        from post_office.settings import get_celery_enabled, get_daemon_notify_enabled
         from post_office.signals import email_queued
 
         if get_celery_enabled():
             email_queued.connect(tasks.queued_mail_handler)
+
+        if get_daemon_notify_enabled():
+            from post_office.daemon import notify_queued
+            email_queued.connect(notify_queued)
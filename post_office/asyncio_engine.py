@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.mail import get_connection
+
+from .backends import BatchSendError
+from .concurrency import get_concurrency_controller
+from .logutils import setup_loghandlers
+from .merging import get_original_errors, merge_messages_for, set_merged_message_ids
+from .settings import get_async_concurrency, get_backend, get_threads_per_process
+
+logger = setup_loghandlers("INFO")
+
+
+class AsyncEngine:
+    """
+    Sends prepared emails from an asyncio event loop running in a background
+    thread, with at most ``ASYNC_CONCURRENCY`` concurrent sends per backend.
+
+    Backends implementing a ``send_messages_async()`` coroutine method are
+    driven natively, by a single instance per backend. Other backends are
+    called from a thread executor of ``threads`` threads, which also bounds
+    their concurrency.
+
+    Like ``multiprocessing.dummy.Pool``, it is closed and joined once done.
+    """
+
+    def __init__(self, threads=None):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._executor = ThreadPoolExecutor(threads or get_threads_per_process())
+        self._semaphores = {}
+        self._backends = {}
+
+    def _get_backend(self, alias):
+        """
+        Returns the native asyncio backend of ``alias``, or None if it only
+        supports synchronous sends.
+        """
+        if alias not in self._backends:
+            backend = get_connection(get_backend(alias))
+            self._backends[alias] = backend if hasattr(backend, 'send_messages_async') else None
+        return self._backends[alias]
+
+    async def _send(self, emails, send_batch):
+        alias = emails[0].backend_alias or 'default'
+        try:
+            if alias not in self._semaphores:
+                self._semaphores[alias] = asyncio.Semaphore(get_async_concurrency(alias))
+            async with self._semaphores[alias]:
+                backend = self._get_backend(alias)
+                if backend is None:
+                    return await self._loop.run_in_executor(self._executor, send_batch, emails)
+                return await self._send_messages(backend, emails)
+        except Exception as e:
+            # Results must be reported for every email, whatever happens
+            logger.exception('Failed to send emails of backend %s' % alias)
+            return [(email, e) for email in emails]
+
+    async def _send_messages(self, backend, emails):
+        original_messages = [email.email_message() for email in emails]
+        messages, indexes = merge_messages_for(backend, original_messages)
+        start = time.monotonic()
+        errors, refused = {}, {}
+        try:
+            await backend.send_messages_async(messages)
+        except BatchSendError as e:
+            errors, refused = e.errors, e.refused
+        except Exception as e:
+            errors = dict.fromkeys(range(len(messages)), e)
+
+        set_merged_message_ids(emails, messages, indexes)
+        exceptions = get_original_errors(errors, indexes, refused, original_messages)
+
+        controller = get_concurrency_controller()
+        if controller is not None:
+            controller.record(emails[0].backend_alias or 'default', time.monotonic() - start,
+                              exceptions)
+
+        for email, exception in zip(emails, exceptions):
+            # Release the prepared message as soon as it's sent
+            email._cached_email_message = None
+            if exception is None:
+                logger.debug('Successfully sent email #%d' % email.id)
+            else:
+                logger.error('Failed to send email #%d: %s' % (email.id, exception))
+        return list(zip(emails, exceptions))
+
+    def submit(self, emails, send_batch, callback):
+        """
+        Schedules sending ``emails``, all of the same backend, then calls
+        ``callback`` with a list of (email, exception) tuples from the event
+        loop thread. ``send_batch`` is called from the thread executor for
+        synchronous backends.
+        """
+        def done(future):
+            try:
+                results = future.result()
+            except BaseException as e:
+                # Such as the send being cancelled, which _send() doesn't catch
+                logger.error('Failed to send emails: %r' % e)
+                results = [(email, e) for email in emails]
+            callback(results)
+
+        future = asyncio.run_coroutine_threadsafe(self._send(emails, send_batch), self._loop)
+        future.add_done_callback(done)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for backend in self._backends.values():
+            if backend is not None:
+                backend.close()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def join(self):
+        self._thread.join()
+        self._loop.close()
@@ -1,11 +1,70 @@
 from collections import OrderedDict
 from email.mime.base import MIMEBase
 from django.core.files.base import ContentFile
+from django.core.mail.backends import smtp
 from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
 
 from .settings import get_default_priority
 
 
+class BatchSendError(Exception):
+    """
+    May be raised by the ``send_messages()`` method of backends sending
+    several messages at once, to report which of them failed. ``errors``
+    maps the index of each failed message to its exception.
+
+    ``refused`` maps the index of each message sent to some of its recipients
+    only to the recipients refused, like the result of ``smtplib.SMTP.sendmail()``.
+    """
+
+    def __init__(self, errors, refused=None):
+        super().__init__('%s messages failed to be sent' % len(errors))
+        self.errors = errors
+        self.refused = refused or {}
+
+
+class SMTPEmailBackend(smtp.EmailBackend):
+    """
+    Django's SMTP backend, also reporting recipients refused by the server
+    while others were accepted, by raising ``BatchSendError``. Identical
+    messages are only merged for backends reporting refused recipients.
+
+    A message failing to be sent doesn't prevent the next ones of the batch
+    from being sent: its exception is reported along with the refusals.
+    """
+    reports_refused_recipients = True
+
+    def send_messages(self, email_messages):
+        self._errors, self._refused = {}, {}
+        num_sent = super().send_messages(email_messages)
+        errors = {index: self._errors[id(message)] for index, message in enumerate(email_messages)
+                  if id(message) in self._errors}
+        refused = {index: self._refused[id(message)] for index, message in enumerate(email_messages)
+                   if id(message) in self._refused}
+        if errors or refused:
+            raise BatchSendError(errors, refused)
+        return num_sent
+
+    def _send(self, email_message):
+        sendmail = self.connection.sendmail
+
+        def record_refused(*args, **kwargs):
+            refused = sendmail(*args, **kwargs)
+            if refused:
+                self._refused[id(email_message)] = refused
+            return refused
+
+        self.connection.sendmail = record_refused
+        try:
+            return super()._send(email_message)
+        except Exception as e:
+            self._errors[id(email_message)] = e
+            return False
+        finally:
+            del self.connection.sendmail
+
+
 class EmailBackend(BaseEmailBackend):
 
     def open(self):
@@ -61,9 +120,9 @@ class EmailBackend(BaseEmailBackend):
                            headers=headers)
 
             if attachment_files:
-                attachments = create_attachments(attachment_files)
-
-                email.attachments.add(*attachments)
+                with transaction.atomic():
+                    attachments = create_attachments(attachment_files)
+                    email.attachments.add(*attachments)
 
             if get_default_priority() == 'now':
                 email.dispatch()
@@ -0,0 +1,113 @@
+import smtplib
+import time
+
+from datetime import timedelta
+
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
+
+from .logutils import setup_loghandlers
+from .settings import (
+    get_cache_backend, get_circuit_breaker_reset_timeout, get_circuit_breaker_threshold,
+)
+
+logger = setup_loghandlers("INFO")
+
+# Holds the state of circuit breakers without a shared cache backend
+_local_cache = LocMemCache('post_office_circuit_breaker', {})
+
+
+def is_connection_error(exception):
+    """
+    Returns whether ``exception`` means that the backend couldn't be reached,
+    rather than it refusing a message.
+    """
+    if isinstance(exception, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(exception, smtplib.SMTPException):
+        return False
+    return isinstance(exception, OSError)
+
+
+class CircuitBreaker:
+    """
+    Stops sending emails through a backend alias after ``threshold``
+    consecutive connection errors. Once ``reset_timeout`` seconds have
+    passed, a single email is let through to probe the backend (half-open):
+    success closes the circuit, failure opens it again.
+
+    The state is kept in Post Office's cache backend, so that all processes
+    using the same cache stop sending together, or in the current process if
+    no cache is configured.
+    """
+
+    def __init__(self, threshold, reset_timeout=60, cache=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        if cache is None or isinstance(cache, DummyCache):
+            cache = _local_cache
+        self.cache = cache
+
+    def _key(self, alias, name):
+        return 'post_office:circuit_breaker:%s:%s' % (alias, name)
+
+    def allow(self, alias):
+        """
+        Returns None if an email may be sent through ``alias``, otherwise the
+        datetime from which it may be retried.
+        """
+        retry_at = self.get_retry_time(alias)
+        if retry_at is not None:
+            return retry_at
+        if self.cache.get(self._key(alias, 'failures'), 0) < self.threshold:
+            return None
+        # Half-open, only one email probes the backend at a time
+        if self.cache.add(self._key(alias, 'probe'), 1, timeout=self.reset_timeout):
+            return None
+        return timezone.now() + timedelta(seconds=self.reset_timeout)
+
+    def get_retry_time(self, alias):
+        """
+        Returns the datetime from which ``alias`` may be probed again if its
+        circuit is open, otherwise None.
+        """
+        opened_at = self.cache.get(self._key(alias, 'open'))
+        if opened_at is None:
+            return None
+        delay = max(opened_at + self.reset_timeout - time.time(), 0)
+        return timezone.now() + timedelta(seconds=delay)
+
+    def record_success(self, alias):
+        if self.cache.get(self._key(alias, 'failures')):
+            self.cache.delete_many([self._key(alias, 'failures'), self._key(alias, 'probe')])
+            logger.info('Circuit breaker of backend %s closed' % alias)
+
+    def record_failure(self, alias):
+        """
+        Records a connection error of ``alias``, and opens its circuit once
+        ``threshold`` of them happened in a row.
+        """
+        key = self._key(alias, 'failures')
+        self.cache.add(key, 0, timeout=None)
+        try:
+            failures = self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, 1, timeout=None)
+            failures = 1
+        if failures >= self.threshold:
+            if self.cache.add(self._key(alias, 'open'), time.time(), timeout=self.reset_timeout):
+                self.cache.delete(self._key(alias, 'probe'))
+                logger.warning('Circuit breaker of backend %s opened after %s connection errors'
+                               % (alias, failures))
+
+
+def get_circuit_breaker():
+    """
+    Returns a ``CircuitBreaker`` configured by ``CIRCUIT_BREAKER_THRESHOLD``
+    and ``CIRCUIT_BREAKER_RESET_TIMEOUT``, or None if it's disabled.
+    """
+    threshold = get_circuit_breaker_threshold()
+    if not threshold:
+        return None
+    return CircuitBreaker(threshold, get_circuit_breaker_reset_timeout(), get_cache_backend())
@@ -0,0 +1,148 @@
+import smtplib
+import threading
+
+from .settings import (
+    get_adaptive_concurrency_enabled, get_concurrency_bounds, get_concurrency_latency_target,
+)
+from .signals import concurrency_changed
+
+# Weight of the latest sample in the smoothed latency
+LATENCY_SMOOTHING = 0.2
+# Without a latency target, backends are deemed overloaded once their
+# latency exceeds this many times the lowest latency observed, and at least
+# MIN_LATENCY_TARGET seconds, below which variations are mere noise
+LATENCY_TOLERANCE = 2
+MIN_LATENCY_TARGET = 0.1
+
+
+def is_overload_error(exception):
+    """
+    Returns whether ``exception`` suggests that the backend is overloaded,
+    such as connection errors and temporary SMTP failures, as opposed to
+    permanent failures of a message.
+    """
+    if isinstance(exception, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(exception, smtplib.SMTPResponseException):
+        return 400 <= exception.smtp_code < 500
+    if isinstance(exception, smtplib.SMTPRecipientsRefused):
+        return bool(exception.recipients) and all(
+            400 <= code < 500 for code, _ in exception.recipients.values())
+    if isinstance(exception, smtplib.SMTPException):
+        return False
+    return isinstance(exception, OSError)
+
+
+class _State:
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.slow_start = True
+        self.latency = None
+        self.min_latency = None
+        self.samples_since_decrease = 0
+
+
+class ConcurrencyController:
+    """
+    Adjusts the number of concurrent sends allowed for each backend alias
+    with an additive increase, multiplicative decrease (AIMD) algorithm.
+
+    Starting from the lower bound, the limit doubles every round of sends
+    (slow start) until the backend shows signs of overload, then grows by
+    one per round. Overload, meaning either errors from
+    ``is_overload_error()`` or a smoothed latency per message above
+    ``latency_target`` seconds, multiplies the limit by ``decrease_factor``,
+    at most once per round.
+
+    ``bounds`` is a callable returning the minimum and maximum limits of an
+    alias.
+    """
+
+    def __init__(self, bounds=get_concurrency_bounds, latency_target=None, decrease_factor=0.5):
+        self.bounds = bounds
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _get_state(self, alias):
+        if alias not in self._states:
+            self._states[alias] = _State(self.bounds(alias)[0])
+        return self._states[alias]
+
+    def get_limit(self, alias):
+        """
+        Returns the number of sends of ``alias`` which may run concurrently.
+        """
+        with self._lock:
+            minimum, maximum = self.bounds(alias)
+            return max(minimum, min(maximum, int(self._get_state(alias).limit)))
+
+    def get_limits(self):
+        """
+        Returns the current limit of each alias seen so far.
+        """
+        return {alias: self.get_limit(alias) for alias in list(self._states)}
+
+    def _is_overloaded(self, state, latency):
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency += LATENCY_SMOOTHING * (latency - state.latency)
+        if self.latency_target is not None:
+            return state.latency > self.latency_target
+        if state.min_latency is None:
+            return False
+        return state.latency > max(LATENCY_TOLERANCE * state.min_latency, MIN_LATENCY_TARGET)
+
+    def record(self, alias, latency, exceptions):
+        """
+        Records a call sending messages of ``alias`` which took ``latency``
+        seconds, with the exception raised for each message, or None.
+        """
+        with self._lock:
+            minimum, maximum = self.bounds(alias)
+            state = self._get_state(alias)
+            previous = max(minimum, min(maximum, int(state.limit)))
+            latency = latency / max(len(exceptions), 1)
+            errors = [exception for exception in exceptions if exception is not None]
+
+            state.samples_since_decrease += 1
+            overloaded = any(is_overload_error(exception) for exception in errors)
+            if self._is_overloaded(state, latency) or overloaded:
+                if state.samples_since_decrease >= state.limit:
+                    state.limit = max(minimum, state.limit * self.decrease_factor)
+                    state.slow_start = False
+                    state.samples_since_decrease = 0
+            elif state.slow_start:
+                state.limit += 1
+            else:
+                state.limit += 1 / state.limit
+            state.limit = max(minimum, min(maximum, state.limit))
+
+            if not errors and (state.min_latency is None or latency < state.min_latency):
+                state.min_latency = latency
+            limit = int(state.limit)
+
+        if limit != previous:
+            concurrency_changed.send(sender=ConcurrencyController, backend_alias=alias,
+                                     concurrency=limit)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_concurrency_controller():
+    """
+    Returns the ``ConcurrencyController`` shared by the current process, or
+    None if ``ADAPTIVE_CONCURRENCY`` is disabled.
+    """
+    global _controller
+    if not get_adaptive_concurrency_enabled():
+        return None
+    with _controller_lock:
+        if _controller is None:
+            _controller = ConcurrencyController(latency_target=get_concurrency_latency_target())
+        return _controller
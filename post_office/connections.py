@@ -1,8 +1,132 @@
-from threading import local
+import os
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock, local
 
 from django.core.mail import get_connection
 
-from .settings import get_backend
+from .settings import (
+    get_backend, get_connection_idle_timeout, get_connection_max_messages, get_connection_pool_size,
+)
+
+# Idle connections are health checked before being reused after this many seconds
+HEALTH_CHECK_IDLE_TIME = 5
+
+
+class ConnectionPool:
+    """
+    Holds opened connections of one backend alias, shared by threads. At most
+    ``max_size`` connections are in use at once, and those idle for more than
+    ``idle_timeout`` seconds, or which sent ``max_messages``, are closed
+    instead of being reused.
+    """
+
+    def __init__(self, alias, max_size, idle_timeout=None, max_messages=None):
+        self.alias = alias
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self._semaphore = BoundedSemaphore(max_size)
+        self._lock = Lock()
+        # Tuples of (connection, number of sent messages, time it was released)
+        self._idle = deque()
+        self._num_messages = {}
+
+    def _create(self):
+        try:
+            backend = get_backend(self.alias)
+        except KeyError:
+            raise KeyError('%s is not a valid backend alias' % self.alias)
+
+        connection = get_connection(backend)
+        connection.open()
+        return connection, 0
+
+    def _get_idle(self):
+        """
+        Returns the most recently released connection which is still usable,
+        with its number of sent messages, or None.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, num_messages, released_at = self._idle.pop()
+
+            idle_time = time.monotonic() - released_at
+            if self.idle_timeout is not None and idle_time > self.idle_timeout:
+                _close(connection)
+            elif idle_time > HEALTH_CHECK_IDLE_TIME and not is_usable(connection):
+                _close(connection)
+            else:
+                return connection, num_messages
+
+    def acquire(self):
+        self._semaphore.acquire()
+        try:
+            connection, num_messages = self._get_idle() or self._create()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        with self._lock:
+            self._num_messages[id(connection)] = num_messages
+        return connection
+
+    def release(self, connection, num_messages=1, discard=False):
+        """
+        Puts ``connection`` back in the pool, after it sent ``num_messages``.
+        Broken connections should be discarded.
+        """
+        with self._lock:
+            num_messages += self._num_messages.pop(id(connection))
+            reuse = not discard and (self.max_messages is None or num_messages < self.max_messages)
+            if reuse:
+                self._idle.append((connection, num_messages, time.monotonic()))
+        if not reuse:
+            _close(connection)
+        self._semaphore.release()
+
+    @contextmanager
+    def connection(self, num_messages=1):
+        """
+        Lends a connection to send ``num_messages`` with.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+        self.release(connection, num_messages)
+
+    def close(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection, _, _ in idle:
+            _close(connection)
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def is_usable(connection):
+    """
+    Checks whether an SMTP connection is still alive. Other backends are
+    assumed to be usable.
+    """
+    smtp = getattr(connection, 'connection', None)
+    if smtp is None or not hasattr(smtp, 'noop'):
+        return True
+    try:
+        return smtp.noop()[0] == 250
+    except Exception:
+        return False
 
 
 # Copied from Django 1.8's django.core.cache.CacheHandler
@@ -14,6 +138,9 @@ class ConnectionHandler:
     """
     def __init__(self):
         self._connections = local()
+        self._pools = {}
+        self._pools_lock = Lock()
+        self._pid = os.getpid()
 
     def __getitem__(self, alias):
         try:
@@ -40,5 +167,28 @@ class ConnectionHandler:
         for connection in self.all():
             connection.close()
 
+    def pool(self, alias):
+        """
+        Returns the ``ConnectionPool`` of ``alias``, shared by all threads of
+        the current process.
+        """
+        with self._pools_lock:
+            if self._pid != os.getpid():
+                # Connections inherited from the parent process can't be shared
+                self._pools = {}
+                self._pid = os.getpid()
+            if alias not in self._pools:
+                self._pools[alias] = ConnectionPool(
+                    alias, get_connection_pool_size(), get_connection_idle_timeout(),
+                    get_connection_max_messages(),
+                )
+            return self._pools[alias]
+
+    def close_pools(self):
+        with self._pools_lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
+
 
 connections = ConnectionHandler()
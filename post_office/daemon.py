@@ -0,0 +1,184 @@
+import select
+import signal
+import threading
+import time
+
+from django.db import close_old_connections, connection as db_connection
+from django.db.models import Min
+from django.utils import timezone
+
+from .lockfile import default_lockfile, FileLock, FileLocked
+from .logutils import setup_loghandlers
+from .mail import (
+    archive_delivered, DeliveryPool, get_queued, requeue_expired_leases, send_queued,
+)
+from .models import Email, STATUS
+from .settings import get_claim_enabled, get_daemon_poll_interval
+
+logger = setup_loghandlers("INFO")
+
+NOTIFY_CHANNEL = 'post_office_queued'
+
+
+def notify_queued(sender, emails, **kwargs):
+    """
+    To be connected to :func:`post_office.signals.email_queued` for waking up
+    daemons listening on PostgreSQL. The notification is delivered once the
+    current transaction commits.
+    """
+    if db_connection.vendor == 'postgresql':
+        with db_connection.cursor() as cursor:
+            cursor.execute('NOTIFY %s' % NOTIFY_CHANNEL)
+
+
+class Wakeup:
+    """
+    Sleeps until the timeout elapses or ``wake()`` is called.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+        self._event.clear()
+
+    def wake(self):
+        self._event.set()
+
+    def close(self):
+        pass
+
+
+class PostgresWakeup(Wakeup):
+    """
+    Also wakes up when emails are queued, by listening to the notifications
+    sent by ``notify_queued()`` on a dedicated database connection.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._connection = db_connection.get_new_connection(db_connection.get_connection_params())
+        self._connection.autocommit = True
+        with self._connection.cursor() as cursor:
+            cursor.execute('LISTEN %s' % NOTIFY_CHANNEL)
+
+    def wait(self, timeout):
+        # Wait in short slices, so that ``wake()`` is noticed without delay
+        # even though it can't interrupt select()
+        deadline = time.monotonic() + timeout
+        while not self._event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self._connection], [], [], min(remaining, 1))
+            if readable:
+                self._connection.poll()
+                if self._connection.notifies:
+                    self._connection.notifies.clear()
+                    break
+        self._event.clear()
+
+    def close(self):
+        self._connection.close()
+
+
+def get_wakeup():
+    if db_connection.vendor == 'postgresql':
+        return PostgresWakeup()
+    return Wakeup()
+
+
+class Daemon:
+    """
+    Keeps sending queued emails until SIGTERM or SIGINT is received. In
+    between, it sleeps until the next scheduled email is due, new emails
+    are queued or ``DAEMON_POLL_INTERVAL`` elapses, whichever comes first.
+    """
+
+    def __init__(self, processes=1, log_level=None):
+        self.processes = processes
+        self.log_level = log_level
+        self.running = False
+        self.wakeup = None
+        self.pool = None
+
+    def stop(self, signum=None, frame=None):
+        if signum is not None:
+            logger.info('Received signal %s, stopping after the current batch.', signum)
+        self.running = False
+        if self.wakeup is not None:
+            self.wakeup.wake()
+
+    def get_timeout(self):
+        """
+        Returns the number of seconds until the next scheduled email is due,
+        capped by ``DAEMON_POLL_INTERVAL``.
+        """
+        timeout = get_daemon_poll_interval()
+        now = timezone.now()
+        next_scheduled_time = Email.objects.filter(
+            status__in=[STATUS.queued, STATUS.requeued], scheduled_time__gt=now,
+        ).aggregate(Min('scheduled_time'))['scheduled_time__min']
+        if next_scheduled_time is not None:
+            timeout = min(timeout, (next_scheduled_time - now).total_seconds())
+        return max(timeout, 0)
+
+    def send_queued(self):
+        if get_claim_enabled():
+            num_requeued = requeue_expired_leases()
+            if num_requeued:
+                logger.info('Requeued %s emails with an expired lease.', num_requeued)
+
+        while self.running and get_queued().exists():
+            send_queued(log_level=self.log_level, pool=self.pool)
+        archive_delivered()
+
+    def run(self):
+        self.running = True
+        self.wakeup = get_wakeup()
+        self.pool = DeliveryPool(self.processes)
+        previous_handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        logger.info('Started sending queued emails as a daemon.')
+        try:
+            while self.running:
+                close_old_connections()
+                try:
+                    self.send_queued()
+                    timeout = self.get_timeout()
+                except Exception as e:
+                    # Keep running, e.g. when the database is temporarily unreachable
+                    logger.exception(e, extra={'status_code': 500})
+                    db_connection.close()
+                    timeout = get_daemon_poll_interval()
+                if self.running:
+                    self.wakeup.wait(timeout)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self.wakeup.close()
+            self.wakeup = None
+            self.pool.close()
+            self.pool = None
+        logger.info('Stopped sending queued emails.')
+
+
+def run_daemon(lockfile=default_lockfile, processes=1, log_level=None):
+    """
+    Runs a ``Daemon``. Unless ``CLAIM_ENABLED`` is set, the lock is held
+    for the daemon's whole lifetime.
+    """
+    daemon = Daemon(processes, log_level)
+    if get_claim_enabled():
+        daemon.run()
+        return
+
+    try:
+        with FileLock(lockfile):
+            logger.info('Acquired lock for sending queued emails at %s.lock', lockfile)
+            daemon.run()
+    except FileLocked:
+        logger.info('Failed to acquire lock, terminating now.')
@@ -1,30 +1,56 @@
+import os
+import queue
+import signal
+import socket
 import sys
+import time
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import connection as db_connection
+from django.db import connection as db_connection, connections as db_connections, transaction
 from django.db.models import Q
-from django.template import Context, Template
+from django.template import Context, Engine, Template
 from django.utils import timezone
+from email.mime.base import MIMEBase
 from email.utils import make_msgid
+from collections import Counter, namedtuple
+from functools import partial
+from itertools import islice
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
+from multiprocessing.util import Finalize
+from uuid import uuid4
 
+from .asyncio_engine import AsyncEngine
+from .backends import BatchSendError
+from .circuitbreaker import get_circuit_breaker, is_connection_error
+from .concurrency import get_concurrency_controller
 from .connections import connections
 from .lockfile import default_lockfile, FileLock, FileLocked
 from .logutils import setup_loghandlers
-from .models import Email, EmailTemplate, Log, PRIORITY, STATUS
+from .models import Attachment, Email, EmailTemplate, Log, PRIORITY, STATUS
+from .merging import get_original_errors, merge_messages_for, set_merged_message_ids
+from .ratelimit import get_rate_limiter
+from .retry import get_retry_policy
 from .settings import (
-    get_available_backends, get_batch_size, get_log_level, get_max_retries, get_message_id_enabled,
-    get_message_id_fqdn, get_retry_timedelta, get_sending_order, get_threads_per_process,
+    get_archive_after, get_available_backends, get_batch_size, get_claim_enabled,
+    get_connection_pool_size, get_delivery_engine, get_domain_group_size,
+    get_domain_grouping_enabled, get_lease_timedelta, get_log_level, get_message_id_enabled,
+    get_message_id_fqdn, get_preparation_memory_budget, get_preparation_window, get_send_many_batch_size, get_send_messages_batch_size,
+    get_sending_order, get_status_flush_size, get_threads_per_process,
 )
 from .signals import email_queued
+from .template.cache import compiled_templates
 from .utils import (
-    create_attachments, get_email_template, parse_emails, parse_priority, split_emails,
+    archive_emails, create_attachment, create_attachments, get_email_template, group_by_domain,
+    parse_emails, parse_priority, split_by_domain, split_emails,
 )
 
 logger = setup_loghandlers("INFO")
 
+# Thread pool of a worker process, see ``DeliveryPool``
+_worker_thread_pool = None
+
 
 def create(sender, recipients=None, cc=None, bcc=None, subject='', message='',
            html_message='', context=None, scheduled_time=None, expires_at=None, headers=None,
@@ -65,14 +91,12 @@ def create(sender, recipients=None, cc=None, bcc=None, subject='', message='',
     else:
 
         if template:
-            subject = template.subject
-            message = template.content
-            html_message = template.html_content
+            templates = compiled_templates.get(template, Engine.get_default())
+        else:
+            templates = (Template(subject), Template(message), Template(html_message))
 
         _context = Context(context or {})
-        subject = Template(subject).render(_context)
-        message = Template(message).render(_context)
-        html_message = Template(html_message).render(_context)
+        subject, message, html_message = (t.render(_context) for t in templates)
 
         email = Email(
             from_email=sender,
@@ -137,14 +161,7 @@ def send(recipients=None, sender=None, template=None, context=None, subject='',
         if html_message:
             raise ValueError('You can\'t specify both "template" and "html_message" arguments')
 
-        # template can be an EmailTemplate instance or name
-        if isinstance(template, EmailTemplate):
-            template = template
-            # If language is specified, ensure template uses the right language
-            if language and template.language != language:
-                template = template.translated_templates.get(language=language)
-        else:
-            template = get_email_template(template, language)
+        template = _get_template(template, language)
 
     if backend and backend not in get_available_backends().keys():
         raise ValueError('%s is not a valid backend alias' % backend)
@@ -154,26 +171,271 @@ def send(recipients=None, sender=None, template=None, context=None, subject='',
                    render_on_delivery, commit=commit, backend=backend)
 
     if attachments:
-        attachments = create_attachments(attachments)
-        email.attachments.add(*attachments)
+        with transaction.atomic():
+            attachments = create_attachments(attachments)
+            email.attachments.add(*attachments)
 
     if priority == PRIORITY.now:
         email.dispatch(log_level=log_level)
-    email_queued.send(sender=Email, emails=[email])
+    if commit:
+        email_queued.send(sender=Email, emails=[email])
 
     return email
 
 
-def send_many(kwargs_list):
+def _get_template(template, language=''):
+    # template can be an EmailTemplate instance or name
+    if isinstance(template, EmailTemplate):
+        # If language is specified, ensure template uses the right language
+        if language and template.language != language:
+            template = template.translated_templates.get(language=language)
+        return template
+    return get_email_template(template, language)
+
+
+def _render_contexts(template, contexts):
     """
-    Similar to mail.send(), but this function accepts a list of kwargs.
-    Internally, it uses Django's bulk_create command for efficiency reasons.
-    Currently send_many() can't be used to send emails with priority = 'now'.
+    Renders the subject, content and html_content of ``template`` for each
+    of the given contexts.
+    """
+    templates = compiled_templates.get(template, Engine.get_default())
+    rendered = []
+    for context in contexts:
+        _context = Context(context or {})
+        rendered.append(tuple(t.render(_context) for t in templates))
+    return rendered
+
+
+def send_bulk_template(template, rows, sender=None, scheduled_time=None, expires_at=None,
+                       headers=None, priority=None, render_on_delivery=False, language='',
+                       backend='', processes=1):
+    """
+    Queues one email per row, all of them using the same ``template``. Each row
+    is a dict with a "recipients" key, and optionally "context", "cc", "bcc"
+    and "headers" keys.
+
+    The template is resolved and compiled once, then rendered for every row,
+    using ``processes`` worker processes if greater than 1. Emails are inserted
+    with Django's bulk_create and returned. This can't be used to send emails
+    with priority = 'now'.
     """
-    emails = [send(commit=False, **kwargs) for kwargs in kwargs_list]
+    if sender is None:
+        sender = settings.DEFAULT_FROM_EMAIL
+
+    priority = parse_priority(priority)
+    if priority == PRIORITY.now:
+        raise ValueError("send_bulk_template() can't be used with priority = 'now'")
+
+    if backend and backend not in get_available_backends().keys():
+        raise ValueError('%s is not a valid backend alias' % backend)
+
+    template = _get_template(template, language)
+
+    rows_fields = []
+    contexts = []
+    for row in rows:
+        unknown_keys = set(row) - {'recipients', 'context', 'cc', 'bcc', 'headers'}
+        if unknown_keys:
+            raise ValueError('Invalid row keys: %s' % ', '.join(sorted(unknown_keys)))
+        fields = {}
+        for field in ('recipients', 'cc', 'bcc'):
+            try:
+                fields[field] = parse_emails(row.get(field))
+            except ValidationError as e:
+                raise ValidationError('%s: %s' % (field, e.message))
+        fields['headers'] = row.get('headers', headers)
+        rows_fields.append(fields)
+        contexts.append(row.get('context'))
+
+    if render_on_delivery:
+        rendered = [None] * len(contexts)
+    elif processes > 1 and len(contexts) > processes:
+        chunk_size = (len(contexts) + processes - 1) // processes
+        chunks = [contexts[i:i + chunk_size] for i in range(0, len(contexts), chunk_size)]
+        with Pool(processes) as pool:
+            results = pool.map(partial(_render_contexts, template), chunks)
+        rendered = [item for result in results for item in result]
+    else:
+        rendered = _render_contexts(template, contexts)
+
+    emails = []
+    for fields, context, content in zip(rows_fields, contexts, rendered):
+        email = Email(
+            from_email=sender,
+            to=fields['recipients'],
+            cc=fields['cc'],
+            bcc=fields['bcc'],
+            scheduled_time=scheduled_time,
+            expires_at=expires_at,
+            message_id=make_msgid(domain=get_message_id_fqdn()) if get_message_id_enabled() else None,
+            headers=fields['headers'], priority=priority, status=STATUS.queued,
+            backend_alias=backend,
+        )
+        if render_on_delivery:
+            email.template = template
+            email.context = context or ''
+        else:
+            email.subject, email.message, email.html_message = content
+        emails.append(email)
+
     if emails:
         Email.objects.bulk_create(emails)
         email_queued.send(sender=Email, emails=emails)
+    return emails
+
+
+SendManyResult = namedtuple('SendManyResult', 'queued errors')
+
+
+class SendManyError(ValidationError):
+    """
+    Raised by send_many() for a chunk holding invalid rows. ``num_queued``
+    is the number of emails of the previous chunks, which remain queued.
+    """
+
+    def __init__(self, errors, num_queued):
+        super().__init__(errors)
+        self.num_queued = num_queued
+
+
+def _build_many(kwargs):
+    """
+    Builds the unsaved email of one send_many() row. Returns the email and
+    the row's attachments, which send() can't add to unsaved emails.
+    """
+    kwargs = dict(kwargs)
+    attachments = kwargs.pop('attachments', None) or {}
+    priority = parse_priority(kwargs.pop('priority', None))
+    # Emails with priority = 'now' are dispatched by send_many() once inserted.
+    # Like with create(), they have no status, so that they aren't queued.
+    email = send(commit=False, priority=None if priority == PRIORITY.now else priority, **kwargs)
+    if priority == PRIORITY.now:
+        email.priority = priority
+        email.status = None
+    return email, attachments
+
+
+def _get_attachment(attachments, filename, filedata):
+    """
+    Returns the attachment created for ``filedata`` by this send_many() call,
+    creating it the first time. Rows share an attachment when they pass the
+    same file object or path under the same name, with the same mimetype
+    and headers if given in the dict form.
+    """
+    if isinstance(filedata, dict):
+        content = filedata.get('file')
+        mimetype = filedata.get('mimetype')
+        headers = tuple(sorted((filedata.get('headers') or {}).items()))
+    else:
+        content, mimetype, headers = filedata, None, ()
+    key = (filename, content if isinstance(content, str) else id(content), mimetype, headers)
+    if key not in attachments:
+        # Keep a reference to filedata, so that the id of its file can't be reused
+        attachments[key] = (filedata, create_attachment(filename, filedata))
+    return attachments[key][1]
+
+
+def send_many(kwargs_list, skip_invalid=False, batch_size=None):
+    """
+    Similar to mail.send(), but this function accepts an iterable of kwargs.
+    Internally, it uses Django's bulk_create command for efficiency reasons.
+
+    ``kwargs_list`` may be a generator: rows are consumed and inserted in
+    chunks of ``batch_size`` (``SEND_MANY_BATCH_SIZE`` by default), each in
+    its own transaction and followed by one ``email_queued`` signal, so
+    that only one chunk of emails is held in memory at a time.
+
+    Each distinct attachment is stored once, and linked to all emails of
+    the rows passing it with bulk inserts. Emails with priority = 'now' are
+    sent in one batch per chunk, once inserted.
+
+    Rows are validated one chunk at a time, before the chunk is queued. By
+    default, a ``SendManyError`` (a ``ValidationError``) mapping the index of
+    each invalid row of the chunk to its errors is raised, leaving previous
+    chunks queued; their number of emails is its ``num_queued``. If
+    ``skip_invalid`` is set, valid rows are queued anyway and the errors
+    of all chunks are collected.
+
+    Returns a ``SendManyResult`` holding the number of queued emails and
+    the mapping of errors.
+    """
+    if batch_size is None:
+        batch_size = get_send_many_batch_size()
+
+    num_queued = 0
+    errors = {}
+    attachments = {}
+    rows = enumerate(kwargs_list)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+
+        emails = []
+        emails_attachments = []
+        log_levels = []
+        chunk_errors = {}
+        for index, kwargs in chunk:
+            try:
+                email, email_attachments = _build_many(kwargs)
+            except (ValidationError, ValueError) as e:
+                chunk_errors[index] = e.messages if isinstance(e, ValidationError) else [str(e)]
+                continue
+            emails.append(email)
+            emails_attachments.append(email_attachments)
+            log_levels.append(kwargs.get('log_level'))
+
+        if chunk_errors and not skip_invalid:
+            raise SendManyError(chunk_errors, num_queued)
+        errors.update(chunk_errors)
+
+        if not emails:
+            continue
+
+        with transaction.atomic():
+            if db_connection.features.can_return_rows_from_bulk_insert:
+                Email.objects.bulk_create(emails, batch_size=batch_size)
+            else:
+                # Emails need their IDs to be linked to attachments or sent
+                saved = [email for email, email_attachments in zip(emails, emails_attachments)
+                         if email_attachments or email.priority == PRIORITY.now]
+                for email in saved:
+                    email.save()
+                Email.objects.bulk_create([email for email in emails if email.pk is None],
+                                          batch_size=batch_size)
+
+            through_objects = []
+            for email, email_attachments in zip(emails, emails_attachments):
+                for filename, filedata in email_attachments.items():
+                    attachment = _get_attachment(attachments, filename, filedata)
+                    through_objects.append(
+                        Attachment.emails.through(attachment_id=attachment.id, email_id=email.id)
+                    )
+            Attachment.emails.through.objects.bulk_create(through_objects, batch_size=batch_size)
+
+        # Send emails with priority = 'now' in one batch per log level
+        emails_now = {}
+        for email, log_level in zip(emails, log_levels):
+            if email.priority == PRIORITY.now:
+                emails_now.setdefault(log_level, []).append(email.id)
+        for log_level, email_ids in emails_now.items():
+            emails_to_send = Email.objects.filter(id__in=email_ids) \
+                .select_related('template').prefetch_related('attachments')
+            _send_bulk(list(emails_to_send), uses_multiprocessing=False, log_level=log_level)
+
+        email_queued.send(sender=Email, emails=emails)
+        num_queued += len(emails)
+
+    return SendManyResult(num_queued, errors)
+
+
+def _get_queued_filter():
+    now = timezone.now()
+    return (
+        Q(status__in=[STATUS.queued, STATUS.requeued]) &
+        (Q(scheduled_time__lte=now) | Q(scheduled_time__isnull=True)) &
+        (Q(expires_at__gt=now) | Q(expires_at__isnull=True))
+    )
 
 
 def get_queued():
@@ -183,22 +445,188 @@ def get_queued():
      - Has scheduled_time before the current time or is None
      - Has expires_at after the current time or is None
     """
-    now = timezone.now()
-    query = (
-        (Q(status=STATUS.queued) | Q(status=STATUS.requeued)) &
-        (Q(scheduled_time__lte=now) | Q(scheduled_time__isnull=True)) &
-        (Q(expires_at__gt=now) | Q(expires_at__isnull=True))
-    )
-    return Email.objects.filter(query) \
+    return Email.objects.filter(_get_queued_filter()) \
                 .select_related('template') \
                 .order_by(*get_sending_order()).prefetch_related('attachments')[:get_batch_size()]
 
 
-def send_queued(processes=1, log_level=None):
+def get_lease_owner():
+    """
+    Returns a token unique to one claim of a worker, in the form of "host:pid:random".
+    """
+    return '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+
+def claim_queued(lease_owner=None):
+    """
+    Atomically claims a batch of emails eligible for sending, by moving them into
+    the ``sending`` status and leasing them to ``lease_owner``. This allows
+    several workers to drain the queue in parallel without sending an email twice.
+
+    On databases supporting ``SELECT ... FOR UPDATE SKIP LOCKED``, rows locked by
+    a concurrent claim are skipped instead of waited for. On other databases, the
+    status transition is conditional, so that concurrent claims can't overlap.
+
+    Returns the queryset of claimed emails.
+    """
+    if lease_owner is None:
+        lease_owner = get_lease_owner()
+
+    queryset = Email.objects.filter(_get_queued_filter()).order_by(*get_sending_order())
+    with transaction.atomic():
+        if db_connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        email_ids = list(queryset.values_list('id', flat=True)[:get_batch_size()])
+        Email.objects.filter(id__in=email_ids, status__in=[STATUS.queued, STATUS.requeued]).update(
+            status=STATUS.sending, lease_owner=lease_owner,
+            lease_expires_at=timezone.now() + get_lease_timedelta(),
+        )
+
+    return Email.objects.filter(status=STATUS.sending, lease_owner=lease_owner) \
+                .select_related('template') \
+                .order_by(*get_sending_order()).prefetch_related('attachments')
+
+
+def requeue_expired_leases():
+    """
+    Puts emails whose lease has expired back into the queue. These are emails
+    claimed by a worker which died before reporting their delivery status.
+    Returns the number of requeued emails.
+    """
+    return Email.objects.filter(status=STATUS.sending, lease_expires_at__lt=timezone.now()) \
+                .update(status=STATUS.requeued, lease_owner='', lease_expires_at=None)
+
+
+def _create_thread_pool(threads=None):
+    """
+    Returns the pool sending emails of a process: a thread pool, or an
+    ``AsyncEngine`` if ``DELIVERY_ENGINE`` is "asyncio".
+    """
+    if threads is None:
+        threads = get_threads_per_process()
+    if get_delivery_engine() == 'asyncio':
+        return AsyncEngine(threads)
+    return ThreadPool(threads)
+
+
+def _init_worker():
+    """
+    Initializes a worker process of a ``DeliveryPool``.
+    """
+    global _worker_thread_pool
+    # Multiprocessing does not play well with database connection
+    # Fix: Close connections inherited from the forking process
+    # https://groups.google.com/forum/#!topic/django-users/eCAIY9DAfG0
+    db_connections.close_all()
+    # Workers are stopped by their pool once they're done with the current batch
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _worker_thread_pool = _create_thread_pool()
+    # Close pooled backend connections when the worker exits
+    Finalize(None, connections.close_pools, exitpriority=10)
+
+
+def _send_bulk_in_worker(email_ids, log_level=None):
+    # Workers fetch their emails by themselves, so that the parent process
+    # doesn't have to load and pickle their content. They are sent in the
+    # order of ``email_ids``, which may be grouped by domain.
+    emails = list(Email.objects.filter(id__in=email_ids)
+                  .select_related('template').prefetch_related('attachments'))
+    positions = {email_id: position for position, email_id in enumerate(email_ids)}
+    emails.sort(key=lambda email: positions[email.id])
+    return _send_bulk(emails, uses_multiprocessing=False, log_level=log_level,
+                      thread_pool=_worker_thread_pool)
+
+
+class DeliveryPool:
     """
-    Sends out all queued mails that has scheduled_time less than now or None
+    Holds the processes and threads used to send batches of emails. A pool
+    is meant to be reused across batches, which saves forking processes and
+    starting threads each time, and lets worker processes keep their database
+    connection.
     """
-    queued_emails = get_queued()
+
+    def __init__(self, processes=1):
+        self.processes = processes
+        if processes > 1:
+            # Forked processes must not share the parent's connection
+            db_connection.close()
+            self.process_pool = Pool(processes, initializer=_init_worker)
+            self.thread_pool = None
+        else:
+            self.process_pool = None
+            self.thread_pool = _create_thread_pool()
+
+    @property
+    def uses_multiprocessing(self):
+        return self.process_pool is not None
+
+    def send(self, emails, log_level=None):
+        """
+        Sends the given emails. If the pool uses multiprocessing, ``emails``
+        is a list of email IDs, split among worker processes. With
+        ``GROUP_BY_DOMAIN``, it is instead a list of emails having at least
+        their recipients and backend loaded, split with ``split_by_domain()``.
+        Returns a tuple of the number of sent, failed and requeued emails.
+        """
+        if not self.uses_multiprocessing:
+            return _send_bulk(emails, uses_multiprocessing=False, log_level=log_level,
+                              thread_pool=self.thread_pool)
+
+        # Don't use more processes than number of emails
+        processes = min(self.processes, len(emails))
+        if get_domain_grouping_enabled():
+            # Every process sends groups of several domains in turn
+            id_lists = [[email.id for email in part]
+                        for part in split_by_domain(emails, get_domain_group_size(), processes)]
+        else:
+            id_lists = split_emails(emails, processes)
+        results = self.process_pool.map(partial(_send_bulk_in_worker, log_level=log_level), id_lists)
+
+        total_sent = sum(result[0] for result in results)
+        total_failed = sum(result[1] for result in results)
+        total_requeued = sum(result[2] for result in results)
+        return total_sent, total_failed, total_requeued
+
+    def close(self):
+        for pool in (self.process_pool, self.thread_pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
+        connections.close_pools()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def send_queued(processes=1, log_level=None, pool=None):
+    """
+    Sends out all queued mails that has scheduled_time less than now or None.
+    If ``CLAIM_ENABLED`` is set, the batch is claimed first, see ``claim_queued()``.
+    Emails are sent using ``pool`` if given, otherwise with a ``DeliveryPool``
+    of ``processes`` created for this batch only. If ``GROUP_BY_DOMAIN`` is
+    set, emails are sent grouped by backend and recipient domain, see
+    ``group_by_domain()``.
+    """
+    if get_claim_enabled():
+        queued_emails = claim_queued()
+    else:
+        queued_emails = get_queued()
+    if pool is not None:
+        processes = pool.processes
+    if processes > 1:
+        # Only fetch IDs, worker processes fetch the emails by themselves
+        if get_domain_grouping_enabled():
+            # Along with recipients and backends, to split emails by domain
+            queued_emails = list(queued_emails.select_related(None).prefetch_related(None)
+                                 .only('id', 'to', 'cc', 'bcc', 'backend_alias'))
+        else:
+            queued_emails = list(queued_emails.prefetch_related(None).values_list('id', flat=True))
+    elif get_domain_grouping_enabled():
+        queued_emails = group_by_domain(queued_emails, get_domain_group_size())
     total_sent, total_failed, total_requeued = 0, 0, 0
     total_email = len(queued_emails)
 
@@ -209,26 +637,11 @@ def send_queued(processes=1, log_level=None):
         log_level = get_log_level()
 
     if queued_emails:
-        # Don't use more processes than number of emails
-        if total_email < processes:
-            processes = total_email
-
-        if processes == 1:
-            total_sent, total_failed, total_requeued = _send_bulk(
-                emails=queued_emails,
-                uses_multiprocessing=False,
-                log_level=log_level,
-            )
+        if pool is not None:
+            total_sent, total_failed, total_requeued = pool.send(queued_emails, log_level)
         else:
-            email_lists = split_emails(queued_emails, processes)
-
-            pool = Pool(processes)
-            results = pool.map(_send_bulk, email_lists)
-            pool.terminate()
-
-            total_sent = sum(result[0] for result in results)
-            total_failed = sum(result[1] for result in results)
-            total_requeued = [result[2] for result in results]
+            with DeliveryPool(processes) as pool:
+                total_sent, total_failed, total_requeued = pool.send(queued_emails, log_level)
 
     logger.info(
         '%s emails attempted, %s sent, %s failed, %s requeued',
@@ -238,7 +651,177 @@ def send_queued(processes=1, log_level=None):
     return total_sent, total_failed, total_requeued
 
 
-def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
+def _leased_to(queryset, lease_owner):
+    """
+    Restricts ``queryset`` to emails still leased to ``lease_owner``, so that
+    a worker whose lease expired doesn't overwrite the status set by the worker
+    which claimed its emails since. Emails sent without claiming have no owner.
+    """
+    if lease_owner:
+        queryset = queryset.filter(status=STATUS.sending, lease_owner=lease_owner)
+    return queryset
+
+
+def _renew_leases(lease_owner):
+    """
+    Extends the lease of the emails still being sent by ``lease_owner`` by
+    LEASE_DURATION, so that batches taking longer than that to send aren't
+    requeued by other workers.
+    """
+    if lease_owner:
+        Email.objects.filter(status=STATUS.sending, lease_owner=lease_owner) \
+            .update(lease_expires_at=timezone.now() + get_lease_timedelta())
+
+
+def _update_leased(emails, fields, lease_owner):
+    """
+    Saves ``fields`` of the given emails still leased to ``lease_owner``.
+    """
+    with transaction.atomic():
+        queryset = _leased_to(Email.objects.filter(id__in=[email.id for email in emails]),
+                              lease_owner)
+        if lease_owner:
+            owned_ids = set(queryset.select_for_update().values_list('id', flat=True))
+            emails = [email for email in emails if email.id in owned_ids]
+        Email.objects.bulk_update(emails, fields)
+
+
+def _mark_sent(emails, lease_owner=''):
+    """
+    Marks the given emails as sent. Emails merged into a message bearing the
+    Message-ID of another one get that Message-ID, while still leased.
+    """
+    if not emails:
+        return
+    merged_ids = {}
+    for email in emails:
+        if email._merged:
+            merged_ids.setdefault(email.message_id, []).append(email.id)
+    with transaction.atomic():
+        for message_id, email_ids in merged_ids.items():
+            _leased_to(Email.objects.filter(id__in=email_ids), lease_owner) \
+                .update(message_id=message_id)
+        _leased_to(Email.objects.filter(id__in=[email.id for email in emails]), lease_owner) \
+            .update(status=STATUS.sent, lease_owner='', lease_expires_at=None)
+
+
+def _get_encoded_size(size):
+    """
+    Returns the length of ``size`` bytes encoded in base64, in lines of 76
+    characters.
+    """
+    encoded_size = 4 * -(-size // 3)
+    return encoded_size + -(-encoded_size // 76)
+
+
+def _get_message_size(message):
+    """
+    Returns the estimated size of a prepared message, in characters. Attachments
+    not encoded yet count for the size of their base64 encoding, which is what
+    is held in memory when the message is sent.
+    """
+    size = len(message.body)
+    size += sum(len(content) for content, _ in getattr(message, 'alternatives', []))
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            payload = attachment.get_payload()
+            if isinstance(payload, str) and attachment['Content-Transfer-Encoding'] == 'base64':
+                size += len(payload)
+            elif isinstance(payload, (str, bytes)):
+                size += _get_encoded_size(len(payload))
+        else:
+            size += _get_encoded_size(len(attachment[1]))
+    return size
+
+
+def _defer(deferred_emails, lease_owner=''):
+    """
+    Puts emails deferred by rate limits or circuit breakers back in the queue,
+    to be sent from the given time on. Unlike failures, this doesn't count as a
+    retry.
+    """
+    emails = []
+    for email, retry_at in deferred_emails:
+        email.status = STATUS.requeued if email.number_of_retries else STATUS.queued
+        email.scheduled_time = retry_at
+        email.lease_owner = ''
+        email.lease_expires_at = None
+        emails.append(email)
+    _update_leased(emails, ['status', 'scheduled_time', 'lease_owner', 'lease_expires_at'],
+                   lease_owner)
+
+
+def _prepare_emails(emails, failed_emails, rate_limiter=None, deferred_emails=None,
+                    circuit_breaker=None):
+    """
+    Lazily prepares emails before we send these to threads for sending, so
+    we don't need to access the DB from within threads. Yields each prepared
+    email with the estimated size of its message. Emails which fail to be
+    prepared are appended to ``failed_emails``.
+
+    Emails exceeding the limits of ``rate_limiter``, or whose backend is
+    disabled by ``circuit_breaker``, aren't prepared, and are appended to
+    ``deferred_emails`` along with the time they may be sent.
+    """
+    # Attachments shared by emails of a batch are read and encoded once
+    mime_parts = {}
+    for email in emails:
+        if circuit_breaker is not None:
+            retry_at = circuit_breaker.allow(email.backend_alias or 'default')
+            if retry_at is not None:
+                deferred_emails.append((email, retry_at))
+                continue
+        if rate_limiter is not None:
+            retry_at = rate_limiter.acquire(email)
+            if retry_at is not None:
+                deferred_emails.append((email, retry_at))
+                continue
+        # Sometimes this can fail, for example when trying to render
+        # email from a faulty Django template
+        try:
+            message = email.prepare_email_message(mime_parts=mime_parts)
+        except Exception as e:
+            logger.exception('Failed to prepare email #%d' % email.id)
+            failed_emails.append((email, e))
+            continue
+        yield email, _get_message_size(message)
+
+
+def _send_messages(emails):
+    """
+    Sends prepared emails of the same backend with a single call to the
+    backend's ``send_messages()``. Returns the exception raised for each
+    email, or None if it was sent. Backends can attribute failures to
+    individual messages by raising ``BatchSendError``, otherwise an
+    exception fails the whole batch.
+
+    With ``MERGE_IDENTICAL_MESSAGES``, emails only differing by their "To"
+    recipients are sent as a single message, whose result applies to all of
+    them, except those whose recipients were refused.
+    """
+    original_messages = [email.email_message() for email in emails]
+    messages, indexes = original_messages, [[index] for index in range(len(emails))]
+    errors, refused = {}, {}
+    try:
+        if get_connection_pool_size():
+            pool = connections.pool(emails[0].backend_alias or 'default')
+            # Counting messages before they're merged errs on the safe side
+            with pool.connection(len(original_messages)) as connection:
+                messages, indexes = merge_messages_for(connection, original_messages)
+                connection.send_messages(messages)
+        else:
+            connection = original_messages[0].get_connection()
+            messages, indexes = merge_messages_for(connection, original_messages)
+            connection.send_messages(messages)
+    except BatchSendError as e:
+        errors, refused = e.errors, e.refused
+    except Exception as e:
+        errors = dict.fromkeys(range(len(messages)), e)
+    set_merged_message_ids(emails, messages, indexes)
+    return get_original_errors(errors, indexes, refused, original_messages)
+
+
+def _send_bulk(emails, uses_multiprocessing=True, log_level=None, thread_pool=None):
     # Multiprocessing does not play well with database connection
     # Fix: Close connections on forking process
     # https://groups.google.com/forum/#!topic/django-users/eCAIY9DAfG0
@@ -251,6 +834,8 @@ def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
     sent_emails = []
     failed_emails = []  # This is a list of two tuples (email, exception)
     email_count = len(emails)
+    # Emails passed at once come from a single claim, if any
+    lease_owner = emails[0].lease_owner if email_count else ''
 
     logger.info('Process started, sending %s emails' % email_count)
 
@@ -258,46 +843,175 @@ def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
         try:
             email.dispatch(log_level=log_level, commit=False,
                            disconnect_after_delivery=False)
-            sent_emails.append(email)
             logger.debug('Successfully sent email #%d' % email.id)
+            return email, None
         except Exception as e:
             logger.exception('Failed to send email #%d' % email.id)
-            failed_emails.append((email, e))
-
-    # Prepare emails before we send these to threads for sending
-    # So we don't need to access the DB from within threads
-    for email in emails:
-        # Sometimes this can fail, for example when trying to render
-        # email from a faulty Django template
-        try:
-            email.prepare_email_message()
-        except Exception as e:
-            logger.exception('Failed to prepare email #%d' % email.id)
-            failed_emails.append((email, e))
-
-    number_of_threads = min(get_threads_per_process(), email_count)
-    pool = ThreadPool(number_of_threads)
-
-    pool.map(send, emails)
-    pool.close()
-    pool.join()
+            return email, e
+        finally:
+            # Release the prepared message as soon as it's sent
+            email._cached_email_message = None
+
+    def send_batch(emails):
+        start = time.monotonic()
+        if len(emails) == 1:
+            batch_results = [send(emails[0])]
+        else:
+            try:
+                exceptions = _send_messages(emails)
+            finally:
+                for email in emails:
+                    email._cached_email_message = None
+            for email, exception in zip(emails, exceptions):
+                if exception is None:
+                    logger.debug('Successfully sent email #%d' % email.id)
+                else:
+                    logger.error('Failed to send email #%d: %s' % (email.id, exception))
+            batch_results = list(zip(emails, exceptions))
+        if controller is not None:
+            controller.record(emails[0].backend_alias or 'default', time.monotonic() - start,
+                              [exception for _, exception in batch_results])
+        return batch_results
+
+    def put_results(batch_results):
+        results.put(batch_results)
+
+    if thread_pool is None:
+        number_of_threads = max(min(get_threads_per_process(), email_count), 1)
+        pool = _create_thread_pool(number_of_threads)
+    else:
+        pool = thread_pool
+
+    # Number of batches being sent by alias, bounded by the adaptive
+    # concurrency controller if enabled
+    controller = get_concurrency_controller()
+    running = Counter()
+    circuit_breaker = get_circuit_breaker()
+    # Tuples of (email, time from which it may be sent) of emails put back in
+    # the queue because of rate limits or an open circuit breaker
+    deferred_emails = []
+
+    def submit(batch):
+        alias = batch[0].backend_alias or 'default'
+        while controller is not None and running[alias] >= controller.get_limit(alias):
+            collect_result()
+        retry_at = circuit_breaker.get_retry_time(alias) if circuit_breaker else None
+        if retry_at is not None:
+            # The backend went down since these emails were prepared
+            for email in batch:
+                email._cached_email_message = None
+                del in_flight[email.id]
+                deferred_emails.append((email, retry_at))
+            return
+        running[alias] += 1
+        if isinstance(pool, AsyncEngine):
+            pool.submit(batch, send_batch, put_results)
+        else:
+            def put_error(exception):
+                # Fail the whole batch instead of waiting for its results forever
+                put_results([(email, exception) for email in batch])
+
+            pool.apply_async(send_batch, (batch,), callback=put_results, error_callback=put_error)
+
+    # Statuses of sent emails are flushed while sending, so that a crashing
+    # process loses at most STATUS_FLUSH_SIZE of them
+    flush_size = get_status_flush_size()
+    unflushed_emails = []
+    results = queue.Queue()
+    # Estimated message size of each email being sent, by ID
+    in_flight = {}
+    # Leases are renewed a few times per LEASE_DURATION while sending
+    renewal_interval = get_lease_timedelta().total_seconds() / 3
+    last_renewal = time.monotonic()
+
+    def renew_leases():
+        nonlocal last_renewal
+        if time.monotonic() - last_renewal >= renewal_interval:
+            _renew_leases(lease_owner)
+            last_renewal = time.monotonic()
+
+    def collect_result():
+        batch_results = results.get()
+        renew_leases()
+        alias = batch_results[0][0].backend_alias or 'default'
+        running[alias] -= 1
+        for email, exception in batch_results:
+            del in_flight[email.id]
+            if circuit_breaker is not None:
+                if exception is None:
+                    circuit_breaker.record_success(alias)
+                elif is_connection_error(exception):
+                    circuit_breaker.record_failure(alias)
+                    retry_at = circuit_breaker.get_retry_time(alias)
+                    if retry_at is not None:
+                        # Failures caused by an outage don't count as retries
+                        deferred_emails.append((email, retry_at))
+                        continue
+            if exception is None:
+                sent_emails.append(email)
+                unflushed_emails.append(email)
+                if len(unflushed_emails) >= flush_size:
+                    _mark_sent(unflushed_emails, lease_owner)
+                    unflushed_emails.clear()
+            else:
+                failed_emails.append((email, exception))
+
+    # Emails are prepared while previous ones are being sent, no further
+    # ahead than PREPARATION_WINDOW emails and PREPARATION_MEMORY_BUDGET. The
+    # window is widened to the largest batch size, so that batches can fill up.
+    window = get_preparation_window()
+    budget = get_preparation_memory_budget()
+
+    def is_window_full():
+        return in_flight and (len(in_flight) >= window or
+                              (budget is not None and sum(in_flight.values()) >= budget))
+
+    # Emails of a backend are sent SEND_MESSAGES_BATCH_SIZE at a time
+    batches = {}
+    for email, size in _prepare_emails(emails, failed_emails, get_rate_limiter(), deferred_emails,
+                                       circuit_breaker):
+        renew_leases()
+        in_flight[email.id] = size
+        alias = email.backend_alias or 'default'
+        batch_size = get_send_messages_batch_size(alias)
+        window = max(window, batch_size)
+        batch = batches.setdefault(alias, [])
+        batch.append(email)
+        if len(batch) >= batch_size:
+            submit(batches.pop(alias))
+
+        if is_window_full():
+            # Send incomplete batches instead of waiting for them to fill up
+            for batch in batches.values():
+                submit(batch)
+            batches = {}
+        while is_window_full():
+            collect_result()
+    for batch in batches.values():
+        submit(batch)
+    while in_flight:
+        collect_result()
+
+    if thread_pool is None:
+        pool.close()
+        pool.join()
 
     connections.close()
 
-    # Update statuses of sent emails
-    email_ids = [email.id for email in sent_emails]
-    Email.objects.filter(id__in=email_ids).update(status=STATUS.sent)
+    _mark_sent(unflushed_emails, lease_owner)
+    _defer(deferred_emails, lease_owner)
 
     # Update statuses and conditionally requeue failed emails
     num_failed, num_requeued = 0, 0
-    max_retries = get_max_retries()
-    scheduled_time = timezone.now() + get_retry_timedelta()
+    retry_policy = get_retry_policy()
+    now = timezone.now()
     emails_failed = [email for email, _ in failed_emails]
 
-    for email in emails_failed:
+    for email, exception in failed_emails:
+        scheduled_time = retry_policy.get_retry_time(email, exception, now)
         if email.number_of_retries is None:
             email.number_of_retries = 0
-        if email.number_of_retries < max_retries:
+        if scheduled_time is not None:
             email.number_of_retries += 1
             email.status = STATUS.requeued
             email.scheduled_time = scheduled_time
@@ -305,8 +1019,11 @@ def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
         else:
             email.status = STATUS.failed
             num_failed += 1
+        email.lease_owner = ''
+        email.lease_expires_at = None
 
-    Email.objects.bulk_update(emails_failed, ['status', 'scheduled_time', 'number_of_retries'])
+    _update_leased(emails_failed, ['status', 'scheduled_time', 'number_of_retries',
+                                   'lease_owner', 'lease_expires_at'], lease_owner)
 
     # If log level is 0, log nothing, 1 logs only sending failures
     # and 2 means log both successes and failures
@@ -333,9 +1050,11 @@ def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
             Log.objects.bulk_create(logs)
 
     logger.info(
-        'Process finished, %s attempted, %s sent, %s failed, %s requeued',
-        email_count, len(sent_emails), num_failed, num_requeued,
+        'Process finished, %s attempted, %s sent, %s failed, %s requeued, %s deferred',
+        email_count, len(sent_emails), num_failed, num_requeued, len(deferred_emails),
     )
+    if controller is not None:
+        logger.info('Concurrency limits: %s', controller.get_limits())
 
     return len(sent_emails), num_failed, num_requeued
 
@@ -343,21 +1062,52 @@ def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
 def send_queued_mail_until_done(lockfile=default_lockfile, processes=1, log_level=None):
     """
     Send mail in queue batch by batch, until all emails have been processed.
+    If ``CLAIM_ENABLED`` is set, each batch is claimed by this worker, hence no lock
+    is acquired and several workers may run concurrently.
     """
+    if get_claim_enabled():
+        num_requeued = requeue_expired_leases()
+        if num_requeued:
+            logger.info('Requeued %s emails with an expired lease.', num_requeued)
+        _send_queued_until_done(processes, log_level)
+        return
+
     try:
         with FileLock(lockfile):
             logger.info('Acquired lock for sending queued emails at %s.lock', lockfile)
-            while True:
-                try:
-                    send_queued(processes, log_level)
-                except Exception as e:
-                    logger.exception(e, extra={'status_code': 500})
-                    raise
-
-                # Close DB connection to avoid multiprocessing errors
-                db_connection.close()
-
-                if not get_queued().exists():
-                    break
+            _send_queued_until_done(processes, log_level)
     except FileLocked:
-        logger.info('Failed to acquire lock, terminating now.')
\ No newline at end of file
+        logger.info('Failed to acquire lock, terminating now.')
+
+
+def _send_queued_until_done(processes, log_level):
+    with DeliveryPool(processes) as pool:
+        while True:
+            try:
+                send_queued(log_level=log_level, pool=pool)
+            except Exception as e:
+                logger.exception(e, extra={'status_code': 500})
+                raise
+
+            if not get_queued().exists():
+                break
+    archive_delivered()
+
+
+def archive_delivered():
+    """
+    Moves emails sent or failed for longer than ``ARCHIVE_AFTER`` to the
+    archive tables, if set, see ``archive_emails()``. Failures are logged
+    instead of raised, so that they can't prevent sending.
+    """
+    archive_after = get_archive_after()
+    if archive_after is None:
+        return 0
+    try:
+        num_archived = archive_emails(timezone.now() - archive_after)
+    except Exception:
+        logger.exception('Failed to archive emails.')
+        return 0
+    if num_archived:
+        logger.info('Archived %s emails.', num_archived)
+    return num_archived
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...mail import get_queued
+from ...models import Email
+
+
+class Command(BaseCommand):
+    help = 'Check that the query plan fetching queued emails uses an index.'
+
+    def handle(self, *args, **options):
+        plan = get_queued().explain()
+        if options['verbosity'] > 1:
+            self.stdout.write(plan)
+
+        index_names = [index.name for index in Email._meta.indexes]
+        used = [name for name in index_names if name in plan]
+        if not used:
+            raise CommandError(
+                "The query fetching queued emails doesn't use any of the %s indexes. "
+                "Make sure migrations are applied, the table statistics are up to date, "
+                "and SENDING_ORDER starts with -priority.\n%s" % (', '.join(index_names), plan)
+            )
+        self.stdout.write("The query fetching queued emails uses the %s index." % ', '.join(used))
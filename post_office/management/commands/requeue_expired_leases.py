@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ...mail import requeue_expired_leases
+
+
+class Command(BaseCommand):
+    help = 'Place emails whose lease has expired back in the queue.'
+
+    def handle(self, *args, **options):
+        num_emails = requeue_expired_leases()
+        self.stdout.write("Requeued {0} mails with an expired lease.".format(num_emails))
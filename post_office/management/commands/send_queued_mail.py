@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from ...daemon import run_daemon
 from ...lockfile import default_lockfile
 from ...mail import send_queued_mail_until_done
 
@@ -22,6 +23,14 @@ class Command(BaseCommand):
             type=int,
             help='"0" to log nothing, "1" to only log errors',
         )
+        parser.add_argument(
+            '-d', '--daemon',
+            action='store_true',
+            help='Keep running and send emails as soon as they are queued, until SIGTERM is received',
+        )
 
     def handle(self, *args, **options):
-        send_queued_mail_until_done(options['lockfile'], options['processes'], options.get('log_level'))
+        if options['daemon']:
+            run_daemon(options['lockfile'], options['processes'], options.get('log_level'))
+        else:
+            send_queued_mail_until_done(options['lockfile'], options['processes'], options.get('log_level'))
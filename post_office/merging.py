@@ -0,0 +1,163 @@
+import copy
+import hashlib
+import smtplib
+
+from email.mime.base import MIMEBase
+from email.utils import parseaddr
+
+from .settings import get_max_merged_recipients, get_merge_identical_messages_enabled
+
+# Headers which differ between otherwise identical messages to different
+# recipients
+PER_RECIPIENT_HEADERS = {'to', 'message-id', 'date'}
+
+
+def _update_digest(digest, value):
+    if isinstance(value, str):
+        value = value.encode('utf-8', 'surrogateescape')
+    elif not isinstance(value, bytes):
+        value = repr(value).encode('utf-8', 'surrogateescape')
+    digest.update(b'%d:' % len(value))
+    digest.update(value)
+
+
+def get_message_digest(message, part_digests=None):
+    """
+    Returns a digest of the content of ``message``, an ``EmailMessage``,
+    excluding its "To" recipients and per-recipient headers. Digests of MIME
+    attachments are cached in ``part_digests`` by object ID, since the same
+    parts are attached to several messages.
+    """
+    if part_digests is None:
+        part_digests = {}
+    digest = hashlib.sha256()
+    for value in (type(message).__name__, message.subject, message.body, message.from_email,
+                  message.content_subtype, getattr(message, 'mixed_subtype', ''),
+                  message.encoding, message.cc, message.reply_to,
+                  getattr(message, 'alternatives', [])):
+        _update_digest(digest, value)
+    for name, value in sorted(message.extra_headers.items()):
+        if name.lower() not in PER_RECIPIENT_HEADERS:
+            _update_digest(digest, '%s: %s' % (name, value))
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            if id(attachment) not in part_digests:
+                part_digests[id(attachment)] = hashlib.sha256(attachment.as_bytes()).digest()
+            _update_digest(digest, part_digests[id(attachment)])
+        else:
+            filename, content, mimetype = attachment
+            _update_digest(digest, filename)
+            _update_digest(digest, content)
+            _update_digest(digest, mimetype)
+    return digest.hexdigest()
+
+
+def _merge(messages):
+    """
+    Returns a copy of the first of ``messages``, sent to the recipients of all
+    of them, which are hidden from each other.
+    """
+    merged = copy.copy(messages[0])
+    merged.extra_headers = dict(merged.extra_headers, To='undisclosed-recipients:;')
+    recipients = []
+    for message in messages:
+        for recipient in list(message.to) + list(message.bcc):
+            if recipient not in recipients:
+                recipients.append(recipient)
+    merged.to = []
+    merged.bcc = recipients
+    return merged
+
+
+def merge_identical_messages(messages, max_recipients=None):
+    """
+    Merges messages which only differ by their "To" recipients into single
+    messages, of at most ``max_recipients`` recipients each. Returns the list
+    of messages to send, and for each of them the indexes of the messages
+    it replaces in ``messages``.
+    """
+    if max_recipients is None:
+        max_recipients = get_max_merged_recipients()
+    part_digests = {}
+    groups = {}
+    for index, message in enumerate(messages):
+        groups.setdefault(get_message_digest(message, part_digests), []).append(index)
+
+    merged_messages, merged_indexes = [], []
+    for indexes in groups.values():
+        chunks, num_recipients = [[]], 0
+        for index in indexes:
+            size = len(messages[index].to) + len(messages[index].bcc)
+            if chunks[-1] and num_recipients + size > max_recipients:
+                chunks.append([])
+                num_recipients = 0
+            chunks[-1].append(index)
+            num_recipients += size
+        for chunk in chunks:
+            if len(chunk) == 1:
+                merged_messages.append(messages[chunk[0]])
+            else:
+                merged_messages.append(_merge([messages[index] for index in chunk]))
+            merged_indexes.append(chunk)
+    return merged_messages, merged_indexes
+
+
+def merge_messages_for(connection, messages):
+    """
+    Merges identical ``messages`` with ``merge_identical_messages()`` if
+    ``MERGE_IDENTICAL_MESSAGES`` is enabled and ``connection`` reports the
+    recipients it refused, without which failures of the recipients of
+    merged messages would go unnoticed.
+    """
+    if get_merge_identical_messages_enabled() and \
+            getattr(connection, 'reports_refused_recipients', False):
+        return merge_identical_messages(messages)
+    return messages, [[index] for index in range(len(messages))]
+
+
+def _normalize_address(address):
+    return parseaddr(address)[1].lower()
+
+
+def get_original_errors(errors, indexes, refused=None, messages=None):
+    """
+    Returns the exception raised for each original message, or None, given
+    ``errors`` of merged messages by index and the ``indexes`` of the
+    messages they replaced, as returned by ``merge_identical_messages()``.
+
+    Original ``messages`` merged into one sent to some of its recipients
+    only, as reported by ``refused``, fail with ``SMTPRecipientsRefused`` if
+    one of their own recipients was refused.
+    """
+    refused = refused or {}
+    exceptions = [None] * sum(len(message_indexes) for message_indexes in indexes)
+    for index, message_indexes in enumerate(indexes):
+        recipients_refused = {_normalize_address(recipient): error
+                              for recipient, error in refused.get(index, {}).items()}
+        for message_index in message_indexes:
+            exceptions[message_index] = errors.get(index)
+            if exceptions[message_index] is None and recipients_refused and len(message_indexes) > 1:
+                message = messages[message_index]
+                own_refused = {recipient: recipients_refused[_normalize_address(recipient)]
+                               for recipient in list(message.to) + list(message.bcc)
+                               if _normalize_address(recipient) in recipients_refused}
+                if own_refused:
+                    exceptions[message_index] = smtplib.SMTPRecipientsRefused(own_refused)
+    return exceptions
+
+
+def set_merged_message_ids(emails, messages, indexes):
+    """
+    Sets the "Message-ID" of merged ``messages``, that of the first email
+    merged into each, on the other ``emails`` they replaced, which are
+    flagged as ``_merged`` to be saved once sent.
+    """
+    for message, message_indexes in zip(messages, indexes):
+        message_id = message.extra_headers.get('Message-ID')
+        if len(message_indexes) < 2 or not message_id:
+            continue
+        for index in message_indexes:
+            email = emails[index]
+            if email.message_id != message_id:
+                email.message_id = message_id
+                email._merged = True
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0011_models_help_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='lease_owner',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255, verbose_name='Lease owner'),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='Lease expires'),
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='status',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(0, 'sent'), (1, 'failed'), (2, 'queued'), (3, 'requeued'), (4, 'sending')], db_index=True, null=True, verbose_name='Status'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import post_office.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0012_email_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='SHA-256 of the content, if deduplicated', max_length=64, verbose_name='Digest'),
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='file',
+            field=models.FileField(max_length=255, upload_to=post_office.models.get_upload_path, verbose_name='File'),
+        ),
+    ]
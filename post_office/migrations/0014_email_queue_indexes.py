@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+# Indexes are not built concurrently, which blocks writes to the email table
+# on PostgreSQL. See "Queue Indexes" in the README for large tables.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0013_attachment_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='email',
+            name='status',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(0, 'sent'), (1, 'failed'), (2, 'queued'), (3, 'requeued'), (4, 'sending')], null=True, verbose_name='Status'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['status', '-priority', 'scheduled_time'], name='post_office_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(condition=models.Q(status__in=[2, 3]), fields=['-priority', 'scheduled_time'], name='post_office_queued_partial'),
+        ),
+    ]
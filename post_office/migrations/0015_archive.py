@@ -0,0 +1,60 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+import post_office.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0014_email_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedEmail',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('from_email', models.CharField(max_length=254, verbose_name='Email From')),
+                ('to', post_office.fields.CommaSeparatedEmailField(blank=True, verbose_name='Email To')),
+                ('cc', post_office.fields.CommaSeparatedEmailField(blank=True, verbose_name='Cc')),
+                ('bcc', post_office.fields.CommaSeparatedEmailField(blank=True, verbose_name='Bcc')),
+                ('subject', models.CharField(blank=True, max_length=989, verbose_name='Subject')),
+                ('message', models.TextField(blank=True, verbose_name='Message')),
+                ('html_message', models.TextField(blank=True, verbose_name='HTML Message')),
+                ('status', models.PositiveSmallIntegerField(blank=True, choices=[(0, 'sent'), (1, 'failed'), (2, 'queued'), (3, 'requeued'), (4, 'sending')], null=True, verbose_name='Status')),
+                ('priority', models.PositiveSmallIntegerField(blank=True, choices=[(0, 'low'), (1, 'medium'), (2, 'high'), (3, 'now')], null=True, verbose_name='Priority')),
+                ('created', models.DateTimeField(db_index=True)),
+                ('last_updated', models.DateTimeField()),
+                ('scheduled_time', models.DateTimeField(blank=True, null=True, verbose_name='Scheduled Time')),
+                ('expires_at', models.DateTimeField(blank=True, null=True, verbose_name='Expires')),
+                ('message_id', models.CharField(max_length=255, null=True, verbose_name='Message-ID')),
+                ('number_of_retries', models.PositiveIntegerField(blank=True, null=True)),
+                ('headers', jsonfield.fields.JSONField(blank=True, null=True, verbose_name='Headers')),
+                ('context', jsonfield.fields.JSONField(blank=True, null=True, verbose_name='Context')),
+                ('backend_alias', models.CharField(blank=True, default='', max_length=64, verbose_name='Backend alias')),
+                ('archived', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Archived')),
+                ('attachments', models.ManyToManyField(blank=True, related_name='archived_emails', to='post_office.Attachment', verbose_name='Attachments')),
+                ('template', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='post_office.emailtemplate', verbose_name='Email template')),
+            ],
+            options={
+                'verbose_name': 'Archived email',
+                'verbose_name_plural': 'Archived emails',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'sent'), (1, 'failed')], verbose_name='Status')),
+                ('exception_type', models.CharField(blank=True, max_length=255, verbose_name='Exception type')),
+                ('message', models.TextField(verbose_name='Message')),
+                ('email', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='logs', to='post_office.archivedemail', verbose_name='Email address')),
+            ],
+            options={
+                'verbose_name': 'Archived log',
+                'verbose_name_plural': 'Archived logs',
+            },
+        ),
+    ]
@@ -1,11 +1,16 @@
+import base64
+import io
+import mimetypes
 import os
 
 from collections import namedtuple
 from uuid import uuid4
+from email.mime.base import MIMEBase
 from email.mime.nonmultipart import MIMENonMultipart
 
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
 from django.db import models
 from django.utils.encoding import smart_str
 from django.utils.translation import pgettext_lazy, gettext_lazy as _
@@ -17,7 +22,11 @@ from post_office.fields import CommaSeparatedEmailField
 
 from .connections import connections
 from .logutils import setup_loghandlers
-from .settings import context_field_class, get_log_level, get_template_engine, get_override_recipients
+from .settings import (
+    context_field_class, get_connection_pool_size, get_large_attachment_size, get_log_level,
+    get_template_engine, get_override_recipients,
+)
+from .template.cache import compiled_templates
 from .validators import validate_email_with_name, validate_template_syntax
 
 
@@ -25,7 +34,7 @@ logger = setup_loghandlers("INFO")
 
 
 PRIORITY = namedtuple('PRIORITY', 'low medium high now')._make(range(4))
-STATUS = namedtuple('STATUS', 'sent failed queued requeued')._make(range(4))
+STATUS = namedtuple('STATUS', 'sent failed queued requeued sending')._make(range(5))
 
 
 class Email(models.Model):
@@ -36,7 +45,8 @@ class Email(models.Model):
     PRIORITY_CHOICES = [(PRIORITY.low, _("low")), (PRIORITY.medium, _("medium")),
                         (PRIORITY.high, _("high")), (PRIORITY.now, _("now"))]
     STATUS_CHOICES = [(STATUS.sent, _("sent")), (STATUS.failed, _("failed")),
-                      (STATUS.queued, _("queued")), (STATUS.requeued, _("requeued"))]
+                      (STATUS.queued, _("queued")), (STATUS.requeued, _("requeued")),
+                      (STATUS.sending, _("sending"))]
 
     from_email = models.CharField(_("Email From"), max_length=254,
                                   validators=[validate_email_with_name])
@@ -53,7 +63,7 @@ class Email(models.Model):
     """
     status = models.PositiveSmallIntegerField(
         _("Status"),
-        choices=STATUS_CHOICES, db_index=True,
+        choices=STATUS_CHOICES,
         blank=True, null=True)
     priority = models.PositiveSmallIntegerField(_("Priority"),
                                                 choices=PRIORITY_CHOICES,
@@ -75,15 +85,34 @@ class Email(models.Model):
     context = context_field_class(_('Context'), blank=True, null=True)
     backend_alias = models.CharField(_("Backend alias"), blank=True, default='',
                                      max_length=64)
+    """
+    Emails claimed by a worker are put in ``sending`` status, and leased to
+    that worker until ``lease_expires_at``.
+    """
+    lease_owner = models.CharField(_("Lease owner"), max_length=255, blank=True,
+                                   default='', editable=False)
+    lease_expires_at = models.DateTimeField(_("Lease expires"), blank=True, null=True,
+                                            db_index=True, editable=False)
 
     class Meta:
         app_label = 'post_office'
         verbose_name = pgettext_lazy("Email address", "Email")
         verbose_name_plural = pgettext_lazy("Email addresses", "Emails")
+        indexes = [
+            # Match the query of get_queued() and its default sending order, and
+            # serve lookups by status
+            models.Index(fields=['status', '-priority', 'scheduled_time'],
+                         name='post_office_queue_idx'),
+            # Only holds queued emails, on databases supporting partial indexes
+            models.Index(fields=['-priority', 'scheduled_time'], name='post_office_queued_partial',
+                         condition=models.Q(status__in=[STATUS.queued, STATUS.requeued])),
+        ]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._cached_email_message = None
+        # Whether the email was merged into a message with another Message-ID
+        self._merged = False
 
     def __str__(self):
         return '%s' % self.to
@@ -97,19 +126,24 @@ class Email(models.Model):
 
         return self.prepare_email_message()
 
-    def prepare_email_message(self):
+    def prepare_email_message(self, mime_parts=None):
         """
         Returns a django ``EmailMessage`` or ``EmailMultiAlternatives`` object,
         depending on whether html_message is empty.
+
+        ``mime_parts`` is an optional dict shared by emails prepared together,
+        caching the encoded MIME part of each attachment by attachment ID, so
+        that attachments shared by these emails are read and encoded once.
         """
         if get_override_recipients():
             self.to = get_override_recipients()
 
         if self.template is not None:
             engine = get_template_engine()
-            subject = engine.from_string(self.template.subject).render(self.context)
-            plaintext_message = engine.from_string(self.template.content).render(self.context)
-            multipart_template = engine.from_string(self.template.html_content)
+            subject_template, plaintext_template, multipart_template = \
+                compiled_templates.get(self.template, engine)
+            subject = subject_template.render(self.context)
+            plaintext_message = plaintext_template.render(self.context)
             html_message = multipart_template.render(self.context)
 
         else:
@@ -118,7 +152,11 @@ class Email(models.Model):
             multipart_template = None
             html_message = self.html_message
 
-        connection = connections[self.backend_alias or 'default']
+        if get_connection_pool_size():
+            # A connection is taken from the pool when sending, see dispatch()
+            connection = None
+        else:
+            connection = connections[self.backend_alias or 'default']
         if isinstance(self.headers, dict) or self.expires_at or self.message_id:
             headers = dict(self.headers or {})
             if self.expires_at:
@@ -150,7 +188,12 @@ class Email(models.Model):
                 to=self.to, bcc=self.bcc, cc=self.cc,
                 headers=headers, connection=connection)
 
+        large_attachment_size = get_large_attachment_size()
         for attachment in self.attachments.all():
+            if mime_parts is not None and attachment.id in mime_parts:
+                msg.attach(mime_parts[attachment.id])
+                continue
+
             if attachment.headers:
                 mime_part = MIMENonMultipart(*attachment.mimetype.split('/'))
                 mime_part.set_payload(attachment.file.read())
@@ -160,10 +203,23 @@ class Email(models.Model):
                     except KeyError:
                         mime_part.add_header(key, val)
                 msg.attach(mime_part)
+            elif (large_attachment_size is not None and attachment.file.size > large_attachment_size
+                  and attachment.get_mimetype().split('/')[0] not in ('text', 'message')):
+                # Text parts need a charset and message parts can't be base64
+                # encoded, which Django's own attachment handling takes care of
+                mime_part = attachment.encode_mime_part()
+                msg.attach(mime_part)
             else:
                 msg.attach(attachment.name, attachment.file.read(), mimetype=attachment.mimetype or None)
+                if mime_parts is not None:
+                    # Encode the attachment now, instead of once per message
+                    mime_part = msg._create_attachment(*msg.attachments.pop())
+                    msg.attach(mime_part)
             attachment.file.close()
 
+            if mime_parts is not None:
+                mime_parts[attachment.id] = mime_part
+
         self._cached_email_message = msg
         return msg
 
@@ -173,7 +229,16 @@ class Email(models.Model):
         Sends email and log the result.
         """
         try:
-            self.email_message().send()
+            email_message = self.email_message()
+            if get_connection_pool_size():
+                with connections.pool(self.backend_alias or 'default').connection() as connection:
+                    email_message.connection = connection
+                    try:
+                        email_message.send()
+                    finally:
+                        email_message.connection = None
+            else:
+                email_message.send()
             status = STATUS.sent
             message = ''
             exception_type = ''
@@ -307,16 +372,25 @@ def get_upload_path(instance, filename):
                         str(date.month), str(date.day), filename)
 
 
+def get_digest_upload_path(digest, filename):
+    """Returns the path of content stored by digest, shared by identical files"""
+    return os.path.join('post_office_attachments', 'sha256', digest[:2],
+                        '{digest}.{ext}'.format(digest=digest, ext=filename.split('.')[-1]))
+
+
 class Attachment(models.Model):
     """
     A model describing an email attachment.
     """
-    file = models.FileField(_('File'), upload_to=get_upload_path)
+    file = models.FileField(_('File'), upload_to=get_upload_path, max_length=255)
     name = models.CharField(_('Name'), max_length=255, help_text=_("The original filename"))
     emails = models.ManyToManyField(Email, related_name='attachments',
                                     verbose_name=_('Emails'))
     mimetype = models.CharField(max_length=255, default='', blank=True)
     headers = JSONField(_('Headers'), blank=True, null=True)
+    digest = models.CharField(_('Digest'), max_length=64, blank=True, default='',
+                              db_index=True, editable=False,
+                              help_text=_("SHA-256 of the content, if deduplicated"))
 
     class Meta:
         app_label = 'post_office'
@@ -325,3 +399,96 @@ class Attachment(models.Model):
 
     def __str__(self):
         return self.name
+
+    def get_mimetype(self):
+        """
+        Returns the mimetype of the attachment, guessed from its name if unset.
+        """
+        return self.mimetype or mimetypes.guess_type(self.name)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+
+    def encode_mime_part(self):
+        """
+        Returns the file as a base64 encoded MIME part. The file is read and
+        encoded chunk by chunk, so that it's never held in memory unencoded.
+        Since the email package needs the payload as a single string, the
+        encoded chunks are still copied into one, which peaks at about twice
+        the encoded size, i.e. 2.7 times the file size.
+        """
+        mime_part = MIMEBase(*self.get_mimetype().split('/', 1))
+        payload = io.StringIO()
+        # Chunks are a multiple of 57 bytes, which are encoded as a line of 76 characters
+        for chunk in self.file.chunks(chunk_size=57 * 1024):
+            payload.write(base64.encodebytes(chunk).decode('ascii'))
+        self.file.close()
+        mime_part.set_payload(payload.getvalue())
+        payload.close()
+        mime_part['Content-Transfer-Encoding'] = 'base64'
+
+        filename = self.name
+        try:
+            filename.encode('ascii')
+        except UnicodeEncodeError:
+            filename = ('utf-8', '', filename)
+        mime_part.add_header('Content-Disposition', 'attachment', filename=filename)
+        return mime_part
+
+
+class ArchivedEmail(models.Model):
+    """
+    A sent or failed email moved out of the queue by ``archive_emails()``,
+    keeping the ID it had as an ``Email``.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    from_email = models.CharField(_("Email From"), max_length=254)
+    to = CommaSeparatedEmailField(_("Email To"))
+    cc = CommaSeparatedEmailField(_("Cc"))
+    bcc = CommaSeparatedEmailField(_("Bcc"))
+    subject = models.CharField(_("Subject"), max_length=989, blank=True)
+    message = models.TextField(_("Message"), blank=True)
+    html_message = models.TextField(_("HTML Message"), blank=True)
+    status = models.PositiveSmallIntegerField(_("Status"), choices=Email.STATUS_CHOICES,
+                                              blank=True, null=True)
+    priority = models.PositiveSmallIntegerField(_("Priority"), choices=Email.PRIORITY_CHOICES,
+                                                blank=True, null=True)
+    created = models.DateTimeField(db_index=True)
+    last_updated = models.DateTimeField()
+    scheduled_time = models.DateTimeField(_("Scheduled Time"), blank=True, null=True)
+    expires_at = models.DateTimeField(_("Expires"), blank=True, null=True)
+    message_id = models.CharField("Message-ID", null=True, max_length=255)
+    number_of_retries = models.PositiveIntegerField(null=True, blank=True)
+    headers = JSONField(_('Headers'), blank=True, null=True)
+    template = models.ForeignKey('post_office.EmailTemplate', blank=True, null=True,
+                                 verbose_name=_("Email template"), on_delete=models.SET_NULL)
+    context = context_field_class(_('Context'), blank=True, null=True)
+    backend_alias = models.CharField(_("Backend alias"), blank=True, default='', max_length=64)
+    attachments = models.ManyToManyField(Attachment, related_name='archived_emails', blank=True,
+                                         verbose_name=_('Attachments'))
+    archived = models.DateTimeField(_("Archived"), auto_now_add=True, db_index=True)
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Archived email")
+        verbose_name_plural = _("Archived emails")
+
+    def __str__(self):
+        return '%s' % self.to
+
+
+class ArchivedLog(models.Model):
+    """
+    The log of an archived email.
+    """
+    email = models.ForeignKey(ArchivedEmail, editable=False, related_name='logs',
+                              verbose_name=_('Email address'), on_delete=models.CASCADE)
+    date = models.DateTimeField()
+    status = models.PositiveSmallIntegerField(_('Status'), choices=Log.STATUS_CHOICES)
+    exception_type = models.CharField(_('Exception type'), max_length=255, blank=True)
+    message = models.TextField(_('Message'))
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Archived log")
+        verbose_name_plural = _("Archived logs")
+
+    def __str__(self):
+        return str(self.date)
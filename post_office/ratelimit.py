@@ -0,0 +1,125 @@
+import threading
+import time
+
+from datetime import timedelta
+from email.utils import parseaddr
+
+from django.core.cache.backends.dummy import DummyCache
+from django.utils import timezone
+
+from .settings import get_backend_rate_limits, get_cache_backend, get_domain_rate_limits
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+# [window, count] of each limit, used without a cache backend
+_local_counters = {}
+_local_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    """
+    Parses a rate such as "100/m" into a number of emails and a period in
+    seconds. Periods are "s", "m", "h" or "d".
+    """
+    try:
+        num, period = rate.split('/')
+        return int(num), PERIODS[period.strip().lower()[0]]
+    except (AttributeError, ValueError, KeyError, IndexError):
+        raise ValueError('Invalid rate "%s", expected a rate like "100/m"' % rate)
+
+
+def get_domains(email):
+    """
+    Returns the set of recipient domains of ``email``.
+    """
+    domains = set()
+    for recipient in list(email.to or []) + list(email.cc or []) + list(email.bcc or []):
+        domains.add(parseaddr(recipient)[1].rpartition('@')[2].lower())
+    return domains
+
+
+class RateLimiter:
+    """
+    Limits the number of emails sent per backend alias and per recipient
+    domain, using fixed-window counters. Counters are kept in Post Office's
+    cache backend, so that limits are shared by all processes using the
+    same cache, or in the current process if no cache (or a dummy cache)
+    is configured.
+
+    ``domain_limits`` may have a "*" key, limiting each domain without a
+    limit of its own.
+    """
+
+    def __init__(self, backend_limits=None, domain_limits=None, cache=None):
+        self.backend_limits = {alias: parse_rate(rate)
+                               for alias, rate in (backend_limits or {}).items()}
+        self.domain_limits = {domain.lower(): parse_rate(rate)
+                              for domain, rate in (domain_limits or {}).items()}
+        # A dummy cache never stores counters, so limits would never be reached
+        self.cache = None if isinstance(cache, DummyCache) else cache
+        # (name, window) tuples of the limits known to be exhausted
+        self._exhausted = set()
+
+    def _get_limits(self, email):
+        limits = []
+        alias = email.backend_alias or 'default'
+        if alias in self.backend_limits:
+            limits.append(('backend:%s' % alias,) + self.backend_limits[alias])
+        for domain in sorted(get_domains(email)):
+            limit = self.domain_limits.get(domain, self.domain_limits.get('*'))
+            if limit is not None:
+                limits.append(('domain:%s' % domain,) + limit)
+        return limits
+
+    def _incr(self, name, window, period, delta=1):
+        """
+        Adds ``delta`` to the counter of ``name`` in ``window``, and returns
+        its new value.
+        """
+        if self.cache is None:
+            with _local_lock:
+                counter = _local_counters.get(name)
+                if counter is None or counter[0] != window:
+                    counter = _local_counters[name] = [window, 0]
+                counter[1] += delta
+                return counter[1]
+
+        key = 'post_office:ratelimit:%s:%s' % (name, window)
+        self.cache.add(key, 0, timeout=period * 2)
+        try:
+            return self.cache.incr(key, delta)
+        except ValueError:
+            # The counter expired in the meantime
+            self.cache.add(key, delta, timeout=period * 2)
+            return delta
+
+    def acquire(self, email):
+        """
+        Counts ``email`` against the limits it is subject to. Returns None if
+        it can be sent now, otherwise the datetime from which it may be sent,
+        without having been counted.
+        """
+        now = time.time()
+        acquired = []
+        for name, num, period in self._get_limits(email):
+            window = int(now // period)
+            if (name, window) in self._exhausted or self._incr(name, window, period) > num:
+                self._exhausted.add((name, window))
+                # Give back what was counted against other limits
+                for args in acquired:
+                    self._incr(*args, delta=-1)
+                return timezone.now() + timedelta(seconds=(window + 1) * period - now)
+            acquired.append((name, window, period))
+        return None
+
+
+def get_rate_limiter():
+    """
+    Returns a ``RateLimiter`` configured by ``BACKEND_RATE_LIMITS`` and
+    ``DOMAIN_RATE_LIMITS``, or None if no limit is configured.
+    """
+    backend_limits = get_backend_rate_limits()
+    domain_limits = get_domain_rate_limits()
+    if not backend_limits and not domain_limits:
+        return None
+    return RateLimiter(backend_limits, domain_limits, get_cache_backend())
@@ -0,0 +1,82 @@
+import random
+import smtplib
+
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .settings import (
+    get_max_retries, get_max_retry_interval, get_permanent_errors, get_retry_backoff,
+    get_retry_jitter, get_retry_policy_class, get_retry_timedelta,
+)
+
+
+def get_smtp_codes(exception):
+    """
+    Returns the SMTP reply codes carried by ``exception``, if any.
+    """
+    if isinstance(exception, smtplib.SMTPResponseException):
+        return [exception.smtp_code]
+    if isinstance(exception, smtplib.SMTPRecipientsRefused):
+        return [code for code, _ in exception.recipients.values()]
+    return []
+
+
+class RetryPolicy:
+    """
+    Decides whether and when failed emails are retried.
+
+    Emails are retried up to ``MAX_RETRIES`` times, the first time after
+    ``RETRY_INTERVAL``, each following delay being ``RETRY_BACKOFF`` times
+    longer than the previous one, up to ``MAX_RETRY_INTERVAL``. Delays are
+    shortened by a random fraction of up to ``RETRY_JITTER``, so that emails
+    failing together aren't retried together.
+
+    Failures are permanent, and never retried, if the exception's type name
+    (as stored in ``Log.exception_type``) or all of its SMTP reply codes are
+    listed in ``PERMANENT_ERRORS``.
+
+    Subclasses set as ``RETRY_POLICY`` may override any of these methods.
+    """
+
+    def __init__(self):
+        self.max_retries = get_max_retries()
+        self.interval = get_retry_timedelta()
+        self.backoff = get_retry_backoff()
+        self.max_interval = get_max_retry_interval()
+        self.jitter = get_retry_jitter()
+        self.permanent_errors = set(get_permanent_errors())
+
+    def is_permanent(self, exception):
+        if type(exception).__name__ in self.permanent_errors:
+            return True
+        codes = get_smtp_codes(exception)
+        return bool(codes) and all(code in self.permanent_errors for code in codes)
+
+    def get_delay(self, number_of_retries):
+        """
+        Returns the time to wait before retrying an email which was already
+        retried ``number_of_retries`` times.
+        """
+        delay = self.interval * self.backoff ** number_of_retries
+        if self.max_interval is not None:
+            delay = min(delay, self.max_interval)
+        if self.jitter:
+            delay *= 1 - random.uniform(0, self.jitter)
+        return delay
+
+    def get_retry_time(self, email, exception, now=None):
+        """
+        Returns the datetime at which ``email``, which failed with
+        ``exception``, should be retried, or None if it shouldn't be.
+        """
+        number_of_retries = email.number_of_retries or 0
+        if number_of_retries >= self.max_retries or self.is_permanent(exception):
+            return None
+        return (now or timezone.now()) + self.get_delay(number_of_retries)
+
+
+def get_retry_policy():
+    """
+    Returns an instance of the ``RETRY_POLICY`` class.
+    """
+    return import_string(get_retry_policy_class())()
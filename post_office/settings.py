@@ -104,6 +104,10 @@ def get_template_engine():
     return template_engines[using]
 
 
+def get_compiled_template_cache_size():
+    return get_config().get('COMPILED_TEMPLATE_CACHE_SIZE', 128)
+
+
 def get_override_recipients():
     return get_config().get('OVERRIDE_RECIPIENTS', None)
 
@@ -116,6 +120,159 @@ def get_retry_timedelta():
     return get_config().get('RETRY_INTERVAL', datetime.timedelta(minutes=15))
 
 
+def get_retry_backoff():
+    return get_config().get('RETRY_BACKOFF', 1)
+
+
+def get_max_retry_interval():
+    return get_config().get('MAX_RETRY_INTERVAL', None)
+
+
+def get_retry_jitter():
+    return get_config().get('RETRY_JITTER', 0)
+
+
+def get_permanent_errors():
+    return get_config().get('PERMANENT_ERRORS', [])
+
+
+def get_retry_policy_class():
+    return get_config().get('RETRY_POLICY', 'post_office.retry.RetryPolicy')
+
+
+def get_claim_enabled():
+    return get_config().get('CLAIM_ENABLED', False)
+
+
+def get_lease_timedelta():
+    return get_config().get('LEASE_DURATION', datetime.timedelta(minutes=10))
+
+
+def get_status_flush_size():
+    return get_config().get('STATUS_FLUSH_SIZE', 10)
+
+
+def get_daemon_poll_interval():
+    return get_config().get('DAEMON_POLL_INTERVAL', 5)
+
+
+def get_daemon_notify_enabled():
+    return get_config().get('DAEMON_NOTIFY', False)
+
+
+def get_domain_grouping_enabled():
+    return get_config().get('GROUP_BY_DOMAIN', False)
+
+
+def get_domain_group_size():
+    return get_config().get('DOMAIN_GROUP_SIZE', 20)
+
+
+def get_send_many_batch_size():
+    return get_config().get('SEND_MANY_BATCH_SIZE', 1000)
+
+
+def get_attachment_dedup_enabled():
+    return get_config().get('ATTACHMENT_DEDUPLICATION', False)
+
+
+def get_large_attachment_size():
+    return get_config().get('LARGE_ATTACHMENT_SIZE', None)
+
+
+def get_preparation_memory_budget():
+    return get_config().get('PREPARATION_MEMORY_BUDGET', None)
+
+
+def get_delivery_engine():
+    return get_config().get('DELIVERY_ENGINE', 'threads')
+
+
+def get_async_concurrency(alias='default'):
+    concurrency = get_config().get('ASYNC_CONCURRENCY', 100)
+    if isinstance(concurrency, dict):
+        return concurrency.get(alias, concurrency.get('default', 100))
+    return concurrency
+
+
+def get_preparation_window():
+    if get_delivery_engine() == 'asyncio':
+        default = 2 * get_async_concurrency()
+    else:
+        default = 2 * get_threads_per_process()
+    return get_config().get('PREPARATION_WINDOW', default)
+
+
+def get_connection_pool_size():
+    return get_config().get('CONNECTION_POOL_SIZE', None)
+
+
+def get_connection_idle_timeout():
+    return get_config().get('CONNECTION_IDLE_TIMEOUT', 60)
+
+
+def get_connection_max_messages():
+    return get_config().get('CONNECTION_MAX_MESSAGES', None)
+
+
+def get_send_messages_batch_size(alias):
+    return get_config().get('SEND_MESSAGES_BATCH_SIZE', {}).get(alias, 1)
+
+
+def get_merge_identical_messages_enabled():
+    return get_config().get('MERGE_IDENTICAL_MESSAGES', False)
+
+
+def get_max_merged_recipients():
+    return get_config().get('MAX_MERGED_RECIPIENTS', 100)
+
+
+def get_backend_rate_limits():
+    return get_config().get('BACKEND_RATE_LIMITS', {})
+
+
+def get_domain_rate_limits():
+    return get_config().get('DOMAIN_RATE_LIMITS', {})
+
+
+def get_circuit_breaker_threshold():
+    return get_config().get('CIRCUIT_BREAKER_THRESHOLD', None)
+
+
+def get_circuit_breaker_reset_timeout():
+    return get_config().get('CIRCUIT_BREAKER_RESET_TIMEOUT', 60)
+
+
+def get_adaptive_concurrency_enabled():
+    return get_config().get('ADAPTIVE_CONCURRENCY', False)
+
+
+def get_concurrency_bounds(alias='default'):
+    """
+    Returns the minimum and maximum number of concurrent sends of ``alias``
+    the adaptive concurrency controller can choose from.
+    """
+    if get_delivery_engine() == 'asyncio':
+        default = get_async_concurrency(alias)
+    else:
+        default = get_threads_per_process()
+    bounds = []
+    for key, default in (('MIN_CONCURRENCY', 1), ('MAX_CONCURRENCY', default)):
+        value = get_config().get(key, default)
+        if isinstance(value, dict):
+            value = value.get(alias, value.get('default', default))
+        bounds.append(value)
+    return tuple(bounds)
+
+
+def get_concurrency_latency_target():
+    return get_config().get('CONCURRENCY_LATENCY_TARGET', None)
+
+
+def get_archive_after():
+    return get_config().get('ARCHIVE_AFTER', None)
+
+
 def get_message_id_enabled():
     return get_config().get('MESSAGE_ID_ENABLED', False)
 
@@ -14,3 +14,19 @@ Example:
     def my_callback(sender, emails, **kwargs):
         print("Just added {} mails to the sending queue".format(len(emails)))
 """
+
+concurrency_changed = Signal()
+"""
+This signal is triggered whenever the adaptive concurrency controller changes
+the number of concurrent sends allowed for a backend, which makes it suitable
+to report as a metric. The backend alias and the new number of concurrent
+sends are passed to the callback handler:
+
+Example:
+    from django.dispatch import receiver
+    from post_office.signals import concurrency_changed
+
+    @receiver(concurrency_changed)
+    def my_callback(sender, backend_alias, concurrency, **kwargs):
+        statsd.gauge('post_office.concurrency.%s' % backend_alias, concurrency)
+"""
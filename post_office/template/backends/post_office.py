@@ -1,3 +1,5 @@
+from threading import local
+
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.template import TemplateDoesNotExist
@@ -6,11 +8,34 @@ from django.template.backends.django import Template as DjangoTemplate, reraise,
 from django.template.engine import Engine
 
 
+class AttachedImages(local):
+    """
+    Images referenced by the latest rendering of a template. They are kept per
+    thread, so that a compiled template can be cached and rendered concurrently.
+    """
+    def __init__(self):
+        self.images = []
+
+    def append(self, image):
+        self.images.append(image)
+
+    def clear(self):
+        self.images = []
+
+    def __iter__(self):
+        return iter(self.images)
+
+
 class Template(DjangoTemplate):
     def __init__(self, template, backend):
-        template._attached_images = []
+        if not isinstance(getattr(template, '_attached_images', None), AttachedImages):
+            template._attached_images = AttachedImages()
         super().__init__(template, backend)
 
+    def render(self, context=None, request=None):
+        self.template._attached_images.clear()
+        return super().render(context, request)
+
     def attach_related(self, email_message):
         assert isinstance(email_message, EmailMultiAlternatives), "Parameter must be of type EmailMultiAlternatives"
         email_message.mixed_subtype = 'related'
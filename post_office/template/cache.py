@@ -0,0 +1,68 @@
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+from ..settings import get_compiled_template_cache_size
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class CompiledTemplateCache:
+    """
+    An in-process LRU cache of compiled ``EmailTemplate`` contents, keyed by the
+    template's primary key, its ``last_updated`` timestamp and the engine used to
+    compile it. Saving a template bumps ``last_updated``, hence outdated entries
+    are never used, and eventually evicted.
+
+    The number of cached templates is bounded by ``COMPILED_TEMPLATE_CACHE_SIZE``.
+    """
+
+    def __init__(self):
+        self._templates = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email_template, engine):
+        """
+        Returns a tuple of the compiled subject, content and html_content of
+        ``email_template``. ``engine`` is anything providing ``from_string()``,
+        i.e. a template backend or a ``django.template.Engine``.
+        """
+        if email_template.pk is None:
+            return self.compile(email_template, engine)
+
+        key = (email_template.pk, email_template.last_updated, engine)
+        with self._lock:
+            templates = self._templates.get(key)
+            if templates is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return templates
+            self.misses += 1
+
+        templates = self.compile(email_template, engine)
+        maxsize = get_compiled_template_cache_size()
+        with self._lock:
+            self._templates[key] = templates
+            while len(self._templates) > maxsize:
+                self._templates.popitem(last=False)
+        return templates
+
+    @staticmethod
+    def compile(email_template, engine):
+        return (
+            engine.from_string(email_template.subject),
+            engine.from_string(email_template.content),
+            engine.from_string(email_template.html_content),
+        )
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, get_compiled_template_cache_size(), len(self._templates))
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = 0
+
+
+compiled_templates = CompiledTemplateCache()
@@ -0,0 +1,87 @@
+import asyncio
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..asyncio_engine import AsyncEngine
+from ..mail import _create_thread_pool, _send_bulk
+from ..models import Email, STATUS
+
+
+class AsyncTestingBackend(BaseEmailBackend):
+    """
+    A native asyncio backend recording the messages it sent, and the
+    maximum number of concurrent sends.
+    """
+    sent = []
+    running = 0
+    max_running = 0
+
+    async def send_messages_async(self, email_messages):
+        cls = AsyncTestingBackend
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        await asyncio.sleep(0.01)
+        cls.running -= 1
+        if any(message.subject == 'cancel' for message in email_messages):
+            raise asyncio.CancelledError()
+        if any(message.subject == 'reject' for message in email_messages):
+            raise Exception('Rejected')
+        cls.sent.extend(email_messages)
+        return len(email_messages)
+
+    def send_messages(self, email_messages):
+        raise AssertionError('Native asyncio backends must be sent asynchronously')
+
+
+@override_settings(POST_OFFICE=dict(
+    settings.POST_OFFICE, DELIVERY_ENGINE='asyncio', ASYNC_CONCURRENCY={'async_tester': 2},
+    BACKENDS=dict(settings.POST_OFFICE['BACKENDS'],
+                  async_tester='post_office.tests.test_asyncio_engine.AsyncTestingBackend'),
+))
+class AsyncEngineTest(TestCase):
+
+    def create_emails(self, subjects, backend_alias):
+        return [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject=subject, message='Message', status=STATUS.queued,
+                                 backend_alias=backend_alias)
+            for subject in subjects
+        ]
+
+    def test_create_thread_pool(self):
+        pool = _create_thread_pool()
+        self.assertIsInstance(pool, AsyncEngine)
+        pool.close()
+        pool.join()
+
+    def test_send_bulk_with_sync_backend(self):
+        emails = self.create_emails(['first', 'second', 'third'], 'locmem')
+        _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual(sorted(message.subject for message in mail.outbox),
+                         ['first', 'second', 'third'])
+        self.assertEqual(Email.objects.filter(status=STATUS.sent).count(), 3)
+
+    def test_send_bulk_with_async_backend(self):
+        AsyncTestingBackend.sent = []
+        AsyncTestingBackend.max_running = 0
+        emails = self.create_emails(['accept'] * 5 + ['reject'], 'async_tester')
+        _send_bulk(emails, uses_multiprocessing=False)
+
+        self.assertEqual(len(AsyncTestingBackend.sent), 5)
+        self.assertEqual(AsyncTestingBackend.max_running, 2)
+        self.assertEqual(Email.objects.filter(status=STATUS.sent).count(), 5)
+        self.assertEqual(Email.objects.get(subject='reject').status, STATUS.requeued)
+        self.assertIsNone(emails[0]._cached_email_message)
+
+    def test_send_bulk_with_cancelled_send(self):
+        """
+        Ensure emails whose send is cancelled are reported as failed, instead
+        of blocking the sender.
+        """
+        emails = self.create_emails(['accept', 'cancel'], 'async_tester')
+        self.assertEqual(_send_bulk(emails, uses_multiprocessing=False), (1, 0, 1))
+        self.assertEqual(Email.objects.get(subject='cancel').status, STATUS.requeued)
@@ -0,0 +1,101 @@
+import smtplib
+import time
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import caches
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ..circuitbreaker import _local_cache, CircuitBreaker, get_circuit_breaker, is_connection_error
+from ..mail import _send_bulk
+from ..models import Email, Log, STATUS
+
+
+class UnreachableBackend(mail.backends.base.BaseEmailBackend):
+    attempts = 0
+
+    def send_messages(self, email_messages):
+        UnreachableBackend.attempts += 1
+        raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        _local_cache.clear()
+        caches['post_office'].clear()
+
+    def test_is_connection_error(self):
+        self.assertTrue(is_connection_error(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_connection_error(smtplib.SMTPConnectError(421, 'Unavailable')))
+        self.assertTrue(is_connection_error(TimeoutError()))
+        self.assertFalse(is_connection_error(smtplib.SMTPDataError(451, 'Try again later')))
+        self.assertFalse(is_connection_error(ValueError()))
+
+    def test_circuit_breaker(self):
+        for cache in (None, caches['post_office']):
+            breaker = CircuitBreaker(2, reset_timeout=0.2, cache=cache)
+            breaker.record_failure('smtp')
+            self.assertIsNone(breaker.allow('smtp'))
+            # Successes reset the count of consecutive failures
+            breaker.record_success('smtp')
+            breaker.record_failure('smtp')
+            self.assertIsNone(breaker.get_retry_time('smtp'))
+            breaker.record_failure('smtp')
+            retry_at = breaker.allow('smtp')
+            self.assertGreater(retry_at, timezone.now())
+            self.assertAlmostEqual(breaker.get_retry_time('smtp'), retry_at,
+                                   delta=timezone.timedelta(seconds=0.1))
+            # Other backends aren't affected
+            self.assertIsNone(breaker.allow('default'))
+
+            # Once half-open, a single email may probe the backend
+            time.sleep(0.25)
+            self.assertIsNone(breaker.allow('smtp'))
+            self.assertIsNotNone(breaker.allow('smtp'))
+            breaker.record_failure('smtp')
+            self.assertIsNotNone(breaker.get_retry_time('smtp'))
+
+            time.sleep(0.25)
+            self.assertIsNone(breaker.allow('smtp'))
+            breaker.record_success('smtp')
+            self.assertIsNone(breaker.allow('smtp'))
+            self.assertIsNone(breaker.allow('smtp'))
+
+    def test_get_circuit_breaker(self):
+        self.assertIsNone(get_circuit_breaker())
+        with override_settings(POST_OFFICE=dict(settings.POST_OFFICE, CIRCUIT_BREAKER_THRESHOLD=3)):
+            breaker = get_circuit_breaker()
+            self.assertEqual(breaker.threshold, 3)
+            self.assertEqual(breaker.reset_timeout, 60)
+
+    def test_send_bulk(self):
+        """
+        Ensure emails aren't sent, nor failed, once the circuit breaker of
+        their backend opens.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='Test', message='Message', status=STATUS.queued,
+                                 backend_alias='unreachable')
+            for i in range(5)
+        ]
+        backends = dict(settings.POST_OFFICE['BACKENDS'],
+                        unreachable='post_office.tests.test_circuitbreaker.UnreachableBackend')
+        UnreachableBackend.attempts = 0
+        with override_settings(POST_OFFICE=dict(settings.POST_OFFICE, BACKENDS=backends,
+                                                THREADS_PER_PROCESS=1, PREPARATION_WINDOW=1,
+                                                CIRCUIT_BREAKER_THRESHOLD=2)):
+            sent, failed, requeued = _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual(UnreachableBackend.attempts, 2)
+        self.assertEqual((sent, failed, requeued), (0, 0, 1))
+        # The failure which opened the circuit doesn't count as a retry
+        email = Email.objects.get(id=emails[1].id)
+        self.assertEqual(email.status, STATUS.queued)
+        self.assertFalse(email.number_of_retries)
+        self.assertEqual(Email.objects.get(id=emails[0].id).number_of_retries, 1)
+        self.assertEqual(Email.objects.filter(status=STATUS.queued,
+                                              scheduled_time__gt=timezone.now()).count(), 4)
+        self.assertEqual(Log.objects.count(), 1)
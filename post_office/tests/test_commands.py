@@ -1,13 +1,18 @@
 import datetime
 import os
 
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
 from django.core.files.base import ContentFile
-from django.core.management import call_command
+from django.core.management import call_command, CommandError
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.utils.timezone import now
 
-from ..models import Attachment, Email, STATUS
+from ..models import ArchivedEmail, Attachment, Email, STATUS
+from ..utils import create_attachments
 
 
 class CommandTest(TestCase):
@@ -64,6 +69,26 @@ class CommandTest(TestCase):
         self.assertEqual(Email.objects.count(), 0)
         self.assertEqual(Attachment.objects.count(), 0)
 
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, ATTACHMENT_DEDUPLICATION=True))
+    def test_cleanup_mail_with_deduplicated_attachments(self):
+        """
+        Files of deduplicated attachments are only deleted once unreferenced.
+        """
+        old_email = Email.objects.create(to=['to@example.com'], from_email='from@example.com')
+        Email.objects.filter(id=old_email.id).update(created=now() - datetime.timedelta(31))
+        email = Email.objects.create(to=['to@example.com'], from_email='from@example.com')
+        old_email.attachments.add(*create_attachments({'old.txt': ContentFile('content')}))
+        email.attachments.add(*create_attachments({'new.txt': ContentFile('content')}))
+        attachment_path = Attachment.objects.get(name='old.txt').file.path
+
+        call_command('cleanup_mail', '-da', days=30)
+        self.assertEqual(list(Attachment.objects.values_list('name', flat=True)), ['new.txt'])
+        self.assertTrue(os.path.exists(attachment_path))
+
+        email.delete()
+        call_command('cleanup_mail', '-da', days=30)
+        self.assertEqual(Attachment.objects.count(), 0)
+        self.assertFalse(os.path.exists(attachment_path))
 
     def test_cleanup_mail(self):
         """
@@ -84,6 +109,73 @@ class CommandTest(TestCase):
         call_command('cleanup_mail', days=30)
         self.assertEqual(Email.objects.count(), 0)
 
+    def test_cleanup_mail_with_archived_emails(self):
+        """
+        The ``cleanup_mail`` command deletes archived emails too, and keeps
+        attachments of archived emails
+        """
+        email = Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                     status=STATUS.sent)
+        attachment = Attachment(name='test.txt')
+        attachment.file.save('test.txt', content=ContentFile('test'), save=True)
+        attachment.emails.add(email)
+        call_command('archive_mail')
+        self.assertEqual(ArchivedEmail.objects.count(), 1)
+
+        call_command('cleanup_mail', days=30, delete_attachments=True)
+        self.assertEqual(ArchivedEmail.objects.count(), 1)
+        self.assertEqual(Attachment.objects.count(), 1)
+
+        ArchivedEmail.objects.update(created=now() - datetime.timedelta(31))
+        call_command('cleanup_mail', days=30, delete_attachments=True)
+        self.assertEqual(ArchivedEmail.objects.count(), 0)
+        self.assertEqual(Attachment.objects.count(), 0)
+
+    def test_send_queued_mail_archives_emails(self):
+        """
+        Sent emails are archived once the queue is empty, if ``ARCHIVE_AFTER`` is set
+        """
+        email = Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                     status=STATUS.queued, backend_alias='locmem')
+        with override_settings(POST_OFFICE=dict(settings.POST_OFFICE,
+                                                ARCHIVE_AFTER=datetime.timedelta(0))):
+            call_command('send_queued_mail', processes=1)
+        self.assertFalse(Email.objects.exists())
+        self.assertEqual(ArchivedEmail.objects.get(id=email.id).status, STATUS.sent)
+
+    def test_requeue_expired_leases(self):
+        """
+        The ``requeue_expired_leases`` command puts emails whose lease has
+        expired back in the queue
+        """
+        email = Email.objects.create(from_email='from@example.com',
+                                     to=['to@example.com'], status=STATUS.sending,
+                                     lease_owner='worker-1',
+                                     lease_expires_at=now() + datetime.timedelta(minutes=1))
+        call_command('requeue_expired_leases')
+        self.assertEqual(Email.objects.get(id=email.id).status, STATUS.sending)
+
+        Email.objects.filter(id=email.id).update(lease_expires_at=now() - datetime.timedelta(minutes=1))
+        call_command('requeue_expired_leases')
+        self.assertEqual(Email.objects.get(id=email.id).status, STATUS.requeued)
+
+    def test_check_queue_indexes(self):
+        """
+        Ensure the query fetching queued emails uses one of the queue indexes.
+        """
+        out = StringIO()
+        call_command('check_queue_indexes', stdout=out)
+        self.assertIn('uses the post_office_', out.getvalue())
+
+        # The query plan is printed with a higher verbosity
+        out = StringIO()
+        call_command('check_queue_indexes', verbosity=2, stdout=out)
+        self.assertGreater(len(out.getvalue().splitlines()), 1)
+
+        with patch('post_office.management.commands.check_queue_indexes.get_queued',
+                   return_value=Email.objects.order_by('id')):
+            self.assertRaises(CommandError, call_command, 'check_queue_indexes', stdout=out)
+
     TEST_SETTINGS = {
         'BACKENDS': {
             'default': 'django.core.mail.backends.dummy.EmailBackend',
@@ -0,0 +1,129 @@
+import smtplib
+
+from django.conf import settings
+from django.core import mail
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .. import concurrency
+from ..concurrency import ConcurrencyController, get_concurrency_controller, is_overload_error
+from ..mail import _send_bulk
+from ..models import Email, STATUS
+from ..signals import concurrency_changed
+
+
+class ConcurrencyControllerTest(TestCase):
+
+    def setUp(self):
+        concurrency._controller = None
+
+    def tearDown(self):
+        concurrency._controller = None
+
+    def test_is_overload_error(self):
+        self.assertTrue(is_overload_error(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_overload_error(ConnectionRefusedError()))
+        self.assertTrue(is_overload_error(smtplib.SMTPDataError(421, 'Try again later')))
+        self.assertFalse(is_overload_error(smtplib.SMTPDataError(550, 'No such user')))
+        self.assertTrue(is_overload_error(smtplib.SMTPRecipientsRefused({'a@example.com': (450, 'Busy')})))
+        self.assertFalse(is_overload_error(smtplib.SMTPRecipientsRefused({'a@example.com': (550, 'No')})))
+        self.assertFalse(is_overload_error(ValueError()))
+
+    def test_additive_increase(self):
+        controller = ConcurrencyController(bounds=lambda alias: (1, 4))
+        self.assertEqual(controller.get_limit('default'), 1)
+        # Slow start grows the limit by one per successful send
+        controller.record('default', 0.1, [None])
+        controller.record('default', 0.1, [None])
+        self.assertEqual(controller.get_limit('default'), 3)
+        # Up to the upper bound
+        for i in range(5):
+            controller.record('default', 0.1, [None])
+        self.assertEqual(controller.get_limit('default'), 4)
+        self.assertEqual(controller.get_limits(), {'default': 4})
+
+    def test_multiplicative_decrease(self):
+        controller = ConcurrencyController(bounds=lambda alias: (1, 8))
+        for i in range(7):
+            controller.record('default', 0.1, [None])
+        self.assertEqual(controller.get_limit('default'), 8)
+
+        controller.record('default', 0.1, [None, smtplib.SMTPServerDisconnected()])
+        self.assertEqual(controller.get_limit('default'), 4)
+        # Further errors of the same round don't decrease the limit again
+        controller.record('default', 0.1, [smtplib.SMTPServerDisconnected()])
+        self.assertEqual(controller.get_limit('default'), 4)
+        # Permanent failures don't decrease the limit
+        for i in range(3):
+            controller.record('default', 0.1, [smtplib.SMTPDataError(550, 'No such user')])
+        self.assertEqual(controller.get_limit('default'), 4)
+
+        # After slow start, the limit grows by about one per round
+        for i in range(4):
+            controller.record('default', 0.1, [None])
+        self.assertEqual(controller.get_limit('default'), 5)
+
+    def test_latency(self):
+        controller = ConcurrencyController(bounds=lambda alias: (1, 8), latency_target=1)
+        for i in range(3):
+            controller.record('default', 0.5, [None])
+        self.assertEqual(controller.get_limit('default'), 4)
+        # Latency is measured per message
+        controller.record('default', 3, [None, None, None, None])
+        self.assertEqual(controller.get_limit('default'), 5)
+        for i in range(10):
+            controller.record('default', 10, [None])
+        self.assertEqual(controller.get_limit('default'), 1)
+
+        # Without a target, latency is compared to the lowest one observed
+        controller = ConcurrencyController(bounds=lambda alias: (1, 8))
+        for i in range(3):
+            controller.record('default', 0.1, [None])
+        for i in range(20):
+            controller.record('default', 2, [None])
+        self.assertEqual(controller.get_limit('default'), 1)
+
+        # Variations of very fast sends are noise, and don't decrease the limit
+        controller = ConcurrencyController(bounds=lambda alias: (1, 8))
+        controller.record('default', 0.001, [None])
+        for i in range(10):
+            controller.record('default', 0.05, [None])
+        self.assertEqual(controller.get_limit('default'), 8)
+
+    def test_concurrency_changed_signal(self):
+        changes = []
+
+        def receiver(sender, backend_alias, concurrency, **kwargs):
+            changes.append((backend_alias, concurrency))
+
+        concurrency_changed.connect(receiver)
+        try:
+            controller = ConcurrencyController(bounds=lambda alias: (1, 2))
+            for i in range(3):
+                controller.record('locmem', 0.1, [None])
+        finally:
+            concurrency_changed.disconnect(receiver)
+        self.assertEqual(changes, [('locmem', 2)])
+
+    def test_get_concurrency_controller(self):
+        self.assertIsNone(get_concurrency_controller())
+        with override_settings(POST_OFFICE=dict(settings.POST_OFFICE, ADAPTIVE_CONCURRENCY=True,
+                                                MAX_CONCURRENCY={'default': 3, 'locmem': 6})):
+            controller = get_concurrency_controller()
+            self.assertIs(get_concurrency_controller(), controller)
+            self.assertEqual(controller.bounds('default'), (1, 3))
+            self.assertEqual(controller.bounds('locmem'), (1, 6))
+
+    def test_send_bulk(self):
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='Test', message='Message', status=STATUS.queued,
+                                 backend_alias='locmem')
+            for i in range(10)
+        ]
+        with override_settings(POST_OFFICE=dict(settings.POST_OFFICE, ADAPTIVE_CONCURRENCY=True,
+                                                MAX_CONCURRENCY=3)):
+            _send_bulk(emails, uses_multiprocessing=False)
+            self.assertEqual(get_concurrency_controller().get_limits(), {'locmem': 3})
+        self.assertEqual(len(mail.outbox), 10)
+        self.assertEqual(Email.objects.filter(status=STATUS.sent).count(), 10)
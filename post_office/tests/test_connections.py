@@ -1,8 +1,16 @@
+from unittest.mock import MagicMock, patch
+
+from django.conf import settings
+from django.core import mail
 from django.core.mail import backends
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from .test_backends import ErrorRaisingBackend
-from ..connections import connections
+from ..connections import ConnectionPool, connections, is_usable
+from ..models import Email, STATUS
+from ..mail import _send_bulk
 
 
 class ConnectionTest(TestCase):
@@ -11,3 +19,72 @@ class ConnectionTest(TestCase):
         # Ensure ConnectionHandler returns the right connection
         self.assertTrue(isinstance(connections['error'], ErrorRaisingBackend))
         self.assertTrue(isinstance(connections['locmem'], backends.locmem.EmailBackend))
+
+    def test_connection_pool(self):
+        pool = ConnectionPool('locmem', max_size=2, max_messages=2)
+        connection = pool.acquire()
+        self.assertIsInstance(connection, backends.locmem.EmailBackend)
+        other_connection = pool.acquire()
+        self.assertIsNot(connection, other_connection)
+
+        # Released connections are reused, until they sent max_messages
+        pool.release(connection)
+        self.assertIs(pool.acquire(), connection)
+        with patch.object(connection, 'close') as close:
+            pool.release(connection)
+        close.assert_called_once_with()
+        self.assertIsNot(pool.acquire(), connection)
+
+    def test_connection_pool_counts_batches(self):
+        pool = ConnectionPool('locmem', max_size=1, max_messages=3)
+        with pool.connection(2) as connection:
+            pass
+        with pool.connection(2) as other_connection:
+            self.assertIs(other_connection, connection)
+        self.assertIsNot(pool.acquire(), connection)
+
+    def test_connection_pool_discards_broken_connections(self):
+        pool = ConnectionPool('locmem', max_size=1)
+        with self.assertRaises(ValueError):
+            with pool.connection() as connection:
+                raise ValueError('Broken connection')
+        self.assertIsNot(pool.acquire(), connection)
+
+    def test_connection_pool_idle_timeout(self):
+        pool = ConnectionPool('locmem', max_size=1, idle_timeout=10)
+        connection = pool.acquire()
+        pool.release(connection)
+        with patch('post_office.connections.time.monotonic', return_value=float('inf')):
+            self.assertIsNot(pool.acquire(), connection)
+
+    def test_is_usable(self):
+        connection = SMTPEmailBackend()
+        self.assertTrue(is_usable(connection))
+        connection.connection = MagicMock()
+        connection.connection.noop.return_value = (250, b'OK')
+        self.assertTrue(is_usable(connection))
+        connection.connection.noop.side_effect = OSError
+        self.assertFalse(is_usable(connection))
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, CONNECTION_POOL_SIZE=2))
+    def test_send_bulk_with_connection_pool(self):
+        """
+        Ensure emails are sent through pooled connections, kept open across batches.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='pool', message='Message', status=STATUS.queued,
+                                 backend_alias='locmem')
+            for _ in range(4)
+        ]
+        pool = connections.pool('locmem')
+        self.assertIs(connections.pool('locmem'), pool)
+        with patch.object(pool, 'acquire', wraps=pool.acquire) as acquire:
+            _send_bulk(emails[:2], uses_multiprocessing=False)
+            _send_bulk(emails[2:], uses_multiprocessing=False)
+        self.assertEqual(acquire.call_count, 4)
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertTrue(pool._idle)
+        connections.close_pools()
+        self.assertFalse(pool._idle)
+        connections._pools = {}
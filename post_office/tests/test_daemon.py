@@ -0,0 +1,53 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core import mail
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ..daemon import Daemon, Wakeup
+from ..models import Email, STATUS
+
+
+class DaemonTest(TestCase):
+
+    def test_wakeup(self):
+        wakeup = Wakeup()
+        wakeup.wake()
+        start = timezone.now()
+        wakeup.wait(10)
+        self.assertLess(timezone.now() - start, timedelta(seconds=1))
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, DAEMON_POLL_INTERVAL=30))
+    def test_get_timeout(self):
+        daemon = Daemon()
+        self.assertEqual(daemon.get_timeout(), 30)
+
+        Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                             status=STATUS.queued,
+                             scheduled_time=timezone.now() + timedelta(seconds=10))
+        self.assertLessEqual(daemon.get_timeout(), 10)
+        self.assertGreater(daemon.get_timeout(), 9)
+
+    @patch('post_office.daemon.close_old_connections')
+    def test_run(self, close_old_connections):
+        """
+        Ensure the daemon sends queued emails, then sleeps until it is stopped.
+        """
+        email = Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                     subject='daemon', status=STATUS.queued,
+                                     backend_alias='locmem')
+        daemon = Daemon()
+
+        def wait(timeout):
+            # Emails have been sent before the daemon went to sleep
+            self.assertEqual(Email.objects.get(id=email.id).status, STATUS.sent)
+            daemon.stop()
+
+        with patch.object(Wakeup, 'wait', side_effect=wait) as wait_mock:
+            daemon.run()
+        self.assertEqual(wait_mock.call_count, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(daemon.running)
@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core import mail
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..mail import send_queued
+from ..models import Email, STATUS
+from ..utils import get_recipient_domain, group_by_domain, split_by_domain
+
+
+class DomainGroupingTest(TestCase):
+
+    def test_get_recipient_domain(self):
+        self.assertEqual(get_recipient_domain(Email(to=['Alice <alice@Example.COM>'])), 'example.com')
+        self.assertEqual(get_recipient_domain(Email(to=[], cc=['bob@example.org'])), 'example.org')
+        self.assertEqual(get_recipient_domain(Email(to=[])), '')
+
+    def test_group_by_domain(self):
+        emails = [
+            Email(id=1, to=['a@gmail.com']),
+            Email(id=2, to=['a@yahoo.com']),
+            Email(id=3, to=['b@gmail.com']),
+            Email(id=4, to=['c@gmail.com'], backend_alias='smtp'),
+            Email(id=5, to=['c@gmail.com']),
+            Email(id=6, to=['d@gmail.com']),
+            Email(id=7, to=['b@yahoo.com']),
+        ]
+        grouped = group_by_domain(emails, 2)
+        # Domains take turns, by groups of 2 emails
+        self.assertEqual([email.id for email in grouped], [1, 3, 2, 7, 4, 5, 6])
+        self.assertEqual([email.id for email in group_by_domain(emails, 10)], [1, 3, 5, 6, 2, 7, 4])
+        self.assertEqual(group_by_domain([], 2), [])
+
+        # Each part starts with groups of different domains
+        parts = split_by_domain(emails, 2, 2)
+        self.assertEqual([[email.id for email in part] for part in parts], [[1, 3, 4], [2, 7, 5, 6]])
+        self.assertEqual(len(split_by_domain(emails[:1], 2, 2)), 1)
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, GROUP_BY_DOMAIN=True,
+                                        DOMAIN_GROUP_SIZE=2, THREADS_PER_PROCESS=1,
+                                        PREPARATION_WINDOW=1))
+    def test_send_queued(self):
+        for recipient in ['a@gmail.com', 'a@yahoo.com', 'b@gmail.com', 'c@gmail.com']:
+            Email.objects.create(to=[recipient], from_email='bob@example.com', subject='Test',
+                                 status=STATUS.queued, backend_alias='locmem')
+        self.assertEqual(send_queued(), (4, 0, 0))
+        self.assertEqual([message.to[0] for message in mail.outbox],
+                         ['a@gmail.com', 'b@gmail.com', 'a@yahoo.com', 'c@gmail.com'])
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, GROUP_BY_DOMAIN=True,
+                                        DOMAIN_GROUP_SIZE=2))
+    def test_send_queued_with_processes(self):
+        for recipient in ['a@gmail.com', 'a@yahoo.com', 'b@gmail.com', 'c@gmail.com']:
+            Email.objects.create(to=[recipient], from_email='bob@example.com', subject='Test',
+                                 status=STATUS.queued)
+        self.assertEqual(send_queued(processes=2), (4, 0, 0))
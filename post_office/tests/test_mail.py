@@ -3,6 +3,7 @@ from datetime import timedelta
 
 import pytz
 import re
+from multiprocessing.dummy import Pool as ThreadPool
 
 from django.core import mail
 from django.core.exceptions import ValidationError
@@ -14,10 +15,13 @@ from django.test.utils import override_settings
 from django.utils import timezone
 
 from ..settings import get_batch_size, get_log_level, get_threads_per_process, get_max_retries, get_retry_timedelta
-from ..models import Email, EmailTemplate, Attachment, PRIORITY, STATUS
-from ..mail import (create, get_queued,
-                    send, send_many, send_queued, _send_bulk)
-
+from ..models import Email, EmailTemplate, Attachment, Log, PRIORITY, STATUS
+from ..mail import (claim_queued, create, get_queued, requeue_expired_leases, DeliveryPool,
+                    send, send_bulk_template, send_many, send_queued, _mark_sent, _prepare_emails,
+                    _renew_leases, _send_bulk, SendManyError)
+from ..backends import BatchSendError
+from ..signals import email_queued
+from ..utils import create_attachments
 
 connection_counter = 0
 
@@ -35,6 +39,22 @@ class ConnectionTestingBackend(mail.backends.base.BaseEmailBackend):
         pass
 
 
+class BatchTestingBackend(mail.backends.base.BaseEmailBackend):
+    '''
+    An EmailBackend recording the number of messages sent at once, which
+    fails to send messages with a "reject" subject
+    '''
+    batches = []
+
+    def send_messages(self, email_messages):
+        self.batches.append(len(email_messages))
+        errors = {index: Exception('Rejected')
+                  for index, message in enumerate(email_messages) if message.subject == 'reject'}
+        if errors:
+            raise BatchSendError(errors)
+        return len(email_messages)
+
+
 class MailTest(TestCase):
 
     @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
@@ -78,6 +98,43 @@ class MailTest(TestCase):
         total_sent, total_failed, total_requeued = send_queued(processes=2)
         self.assertEqual(total_sent, 3)
 
+    def test_delivery_pool_reused_across_batches(self):
+        """
+        Ensure a DeliveryPool sends several batches with the same threads.
+        """
+        kwargs = {
+            'to': ['to@example.com'],
+            'from_email': 'bob@example.com',
+            'subject': 'Test',
+            'message': 'Message',
+            'status': STATUS.queued,
+            'backend_alias': 'locmem',
+        }
+        with patch('post_office.mail.ThreadPool', wraps=ThreadPool) as thread_pool:
+            with DeliveryPool() as pool:
+                Email.objects.create(**kwargs)
+                self.assertEqual(send_queued(pool=pool), (1, 0, 0))
+                Email.objects.create(**kwargs)
+                self.assertEqual(send_queued(pool=pool), (1, 0, 0))
+        self.assertEqual(thread_pool.call_count, 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_delivery_pool_multi_processes(self):
+        """
+        Ensure a DeliveryPool with several processes sends batches of email IDs.
+        """
+        kwargs = {
+            'to': ['to@example.com'],
+            'from_email': 'bob@example.com',
+            'subject': 'Test',
+            'message': 'Message',
+            'status': STATUS.queued,
+        }
+        email_ids = [Email.objects.create(**kwargs).id for i in range(4)]
+        with DeliveryPool(processes=2) as pool:
+            self.assertEqual(pool.send(email_ids[:3]), (3, 0, 0))
+            self.assertEqual(pool.send(email_ids[3:]), (1, 0, 0))
+
     def test_send_bulk(self):
         """
         Ensure _send_bulk() properly sends out emails.
@@ -108,6 +165,45 @@ class MailTest(TestCase):
         _send_bulk([email, email_2])
         self.assertEqual(connection_counter, 1)
 
+    def test_send_bulk_template(self):
+        """
+        Ensure send_bulk_template() queues one rendered email per row.
+        """
+        template = EmailTemplate.objects.create(
+            name='bulk', subject='Hi {{ name }}', content='Content {{ name }}',
+            html_content='HTML {{ name }}')
+        rows = [
+            {'recipients': 'alice@example.com', 'context': {'name': 'Alice'}},
+            {'recipients': ['bob@example.com'], 'cc': 'cc@example.com', 'context': {'name': 'Bob'}},
+        ]
+        emails = send_bulk_template('bulk', rows, sender='from@example.com')
+        self.assertEqual(len(emails), 2)
+        self.assertEqual(Email.objects.filter(status=STATUS.queued).count(), 2)
+        email = Email.objects.get(to=['bob@example.com'])
+        self.assertEqual(email.subject, 'Hi Bob')
+        self.assertEqual(email.message, 'Content Bob')
+        self.assertEqual(email.html_message, 'HTML Bob')
+        self.assertEqual(email.cc, ['cc@example.com'])
+        self.assertIsNone(email.template)
+
+        # Rendering may be delegated to worker processes
+        rows = [{'recipients': 'to%d@example.com' % i, 'context': {'name': i}} for i in range(5)]
+        emails = send_bulk_template(template, rows, processes=2)
+        self.assertEqual([email.subject for email in emails], ['Hi %d' % i for i in range(5)])
+
+        emails = send_bulk_template(template, rows[:1], render_on_delivery=True)
+        self.assertEqual(emails[0].template, template)
+        self.assertEqual(emails[0].subject, '')
+        self.assertEqual(emails[0].email_message().subject, 'Hi 0')
+
+    def test_send_bulk_template_validation(self):
+        template = EmailTemplate.objects.create(name='bulk', subject='Hi')
+        rows = [{'recipients': 'alice@example.com'}, {'recipients': 'invalid'}]
+        self.assertRaises(ValidationError, send_bulk_template, template, rows)
+        self.assertRaises(ValueError, send_bulk_template, template, [{'to': 'alice@example.com'}])
+        self.assertRaises(ValueError, send_bulk_template, template, rows[:1], priority='now')
+        self.assertEqual(Email.objects.count(), 0)
+
     def test_get_queued(self):
         """
         Ensure get_queued returns only emails that should be sent
@@ -141,6 +237,247 @@ class MailTest(TestCase):
                                           scheduled_time=timezone.datetime(2010, 12, 13), **kwargs)
         self.assertEqual(list(get_queued()), [queued_email, past_email])
 
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, BATCH_SIZE=2))
+    def test_claim_queued(self):
+        """
+        Ensure claim_queued leases a batch of queued emails to a single owner.
+        """
+        kwargs = {
+            'to': 'to@example.com',
+            'from_email': 'bob@example.com',
+            'subject': 'Test',
+            'message': 'Message',
+        }
+        Email.objects.create(status=STATUS.sent, **kwargs)
+        Email.objects.create(status=STATUS.queued, scheduled_time=timezone.now() + timedelta(days=1), **kwargs)
+        emails = [Email.objects.create(status=STATUS.queued, **kwargs) for _ in range(3)]
+
+        claimed = list(claim_queued(lease_owner='worker-1'))
+        self.assertEqual(claimed, emails[:2])
+        for email in claimed:
+            self.assertEqual(email.status, STATUS.sending)
+            self.assertEqual(email.lease_owner, 'worker-1')
+            self.assertGreater(email.lease_expires_at, timezone.now())
+
+        # Claimed emails are no longer eligible for sending
+        self.assertEqual(list(get_queued()), emails[2:])
+        self.assertEqual(list(claim_queued(lease_owner='worker-2')), emails[2:])
+        self.assertEqual(list(claim_queued(lease_owner='worker-3')), [])
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, CLAIM_ENABLED=True))
+    def test_send_queued_with_claim(self):
+        """
+        Ensure emails claimed by send_queued are released once sent.
+        """
+        email = Email.objects.create(
+            to=['to@example.com'], from_email='bob@example.com',
+            subject='claimed', message='Message', status=STATUS.queued,
+            backend_alias='locmem')
+        self.assertEqual(send_queued(), (1, 0, 0))
+        email.refresh_from_db()
+        self.assertEqual(email.status, STATUS.sent)
+        self.assertEqual(email.lease_owner, '')
+        self.assertIsNone(email.lease_expires_at)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_requeue_expired_leases(self):
+        """
+        Ensure only emails with an expired lease are put back into the queue.
+        """
+        kwargs = {
+            'to': 'to@example.com',
+            'from_email': 'bob@example.com',
+            'subject': 'Test',
+            'message': 'Message',
+            'status': STATUS.sending,
+            'lease_owner': 'worker-1',
+        }
+        expired = Email.objects.create(lease_expires_at=timezone.now() - timedelta(seconds=1), **kwargs)
+        leased = Email.objects.create(lease_expires_at=timezone.now() + timedelta(minutes=1), **kwargs)
+
+        self.assertEqual(requeue_expired_leases(), 1)
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, STATUS.requeued)
+        self.assertEqual(expired.lease_owner, '')
+        self.assertIsNone(expired.lease_expires_at)
+        leased.refresh_from_db()
+        self.assertEqual(leased.status, STATUS.sending)
+        self.assertEqual(list(get_queued()), [expired])
+
+    def test_renew_leases(self):
+        """
+        Ensure only the leases of emails still being sent by their owner are renewed.
+        """
+        kwargs = {
+            'to': 'to@example.com',
+            'from_email': 'bob@example.com',
+            'subject': 'Test',
+            'message': 'Message',
+            'lease_expires_at': timezone.now() + timedelta(seconds=1),
+        }
+        leased = Email.objects.create(status=STATUS.sending, lease_owner='worker-1', **kwargs)
+        other = Email.objects.create(status=STATUS.sending, lease_owner='worker-2', **kwargs)
+        _renew_leases('worker-1')
+        leased.refresh_from_db()
+        self.assertGreater(leased.lease_expires_at, timezone.now() + timedelta(minutes=9))
+        other.refresh_from_db()
+        self.assertEqual(other.lease_expires_at, kwargs['lease_expires_at'])
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, CLAIM_ENABLED=True))
+    def test_send_bulk_after_lease_lost(self):
+        """
+        Ensure a sender whose lease expired doesn't overwrite the status of
+        emails claimed by another sender since.
+        """
+        kwargs = {
+            'to': ['to@example.com'],
+            'from_email': 'bob@example.com',
+            'subject': 'Test',
+            'message': 'Message',
+            'backend_alias': 'locmem',
+        }
+        sent = Email.objects.create(status=STATUS.queued, **kwargs)
+        failed = Email.objects.create(status=STATUS.queued, **dict(kwargs, backend_alias='error'))
+        emails = list(claim_queued(lease_owner='worker-1'))
+        Email.objects.update(lease_owner='worker-2')
+
+        _send_bulk(emails, uses_multiprocessing=False)
+        for email in (sent, failed):
+            email.refresh_from_db()
+            self.assertEqual(email.status, STATUS.sending)
+            self.assertEqual(email.lease_owner, 'worker-2')
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, STATUS_FLUSH_SIZE=1))
+    def test_send_bulk_flushes_statuses(self):
+        """
+        Ensure statuses of sent emails are flushed while the batch is being sent.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='flush', message='Message', status=STATUS.queued,
+                                 backend_alias='locmem')
+            for _ in range(3)
+        ]
+        with patch('post_office.mail._mark_sent', wraps=_mark_sent) as mark_sent:
+            _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual(mark_sent.call_count, 4)
+        self.assertEqual(Email.objects.filter(status=STATUS.sent).count(), 3)
+
+    def test_prepare_emails(self):
+        """
+        Ensure emails are lazily prepared, along with the size of their message.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='prepare', message=message, status=STATUS.queued)
+            for message in ['Short', 'Long message']
+        ]
+        prepared = _prepare_emails(emails, [])
+        self.assertIsNone(emails[0]._cached_email_message)
+        self.assertEqual(next(prepared), (emails[0], 5))
+        self.assertIsNone(emails[1]._cached_email_message)
+        self.assertEqual(list(prepared), [(emails[1], 12)])
+
+        # Attachments count for their base64 encoded size, 76 characters a line
+        emails[0].attachments.add(*create_attachments({'file.bin': ContentFile(b'x' * 114)}))
+        emails[0]._cached_email_message = None
+        self.assertEqual(list(_prepare_emails(emails[:1], [])), [(emails[0], 5 + 152 + 2)])
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, PREPARATION_WINDOW=1))
+    def test_send_bulk_prepares_just_in_time(self):
+        """
+        Ensure emails aren't prepared further ahead than the preparation window,
+        and their messages are released once sent.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='window', message='Message', status=STATUS.queued,
+                                 backend_alias='locmem')
+            for _ in range(3)
+        ]
+        events = []
+        prepare_email_message = Email.prepare_email_message
+        dispatch = Email.dispatch
+
+        def prepare(email, *args, **kwargs):
+            events.append(('prepare', email.id))
+            return prepare_email_message(email, *args, **kwargs)
+
+        def send(email, *args, **kwargs):
+            events.append(('send', email.id))
+            return dispatch(email, *args, **kwargs)
+
+        with patch.object(Email, 'prepare_email_message', prepare), patch.object(Email, 'dispatch', send):
+            _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual(events, [(event, email.id) for email in emails for event in ('prepare', 'send')])
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIsNone(emails[0]._cached_email_message)
+
+    @override_settings(POST_OFFICE=dict(
+        settings.POST_OFFICE, SEND_MESSAGES_BATCH_SIZE={'batch_tester': 3},
+        BACKENDS=dict(settings.POST_OFFICE['BACKENDS'],
+                      batch_tester='post_office.tests.test_mail.BatchTestingBackend'),
+    ))
+    def test_send_bulk_in_batches(self):
+        """
+        Ensure emails are handed to backends in batches, and failures are
+        attributed to the right emails.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject=subject, message='Message', status=STATUS.queued,
+                                 backend_alias='batch_tester')
+            for subject in ['accept', 'reject', 'accept', 'accept']
+        ]
+        BatchTestingBackend.batches = []
+        _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual(BatchTestingBackend.batches, [3, 1])
+        self.assertEqual(
+            list(Email.objects.order_by('id').values_list('status', flat=True)),
+            [STATUS.sent, STATUS.requeued, STATUS.sent, STATUS.sent],
+        )
+        self.assertEqual(Log.objects.get(status=STATUS.failed).message, 'Rejected')
+
+    @override_settings(POST_OFFICE=dict(
+        settings.POST_OFFICE, SEND_MESSAGES_BATCH_SIZE={'batch_tester': 3}, PREPARATION_WINDOW=1,
+        BACKENDS=dict(settings.POST_OFFICE['BACKENDS'],
+                      batch_tester='post_office.tests.test_mail.BatchTestingBackend'),
+    ))
+    def test_send_bulk_batches_larger_than_window(self):
+        """
+        Ensure batches aren't capped by a smaller preparation window.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='accept', message='Message', status=STATUS.queued,
+                                 backend_alias='batch_tester')
+            for _ in range(4)
+        ]
+        BatchTestingBackend.batches = []
+        self.assertEqual(_send_bulk(emails, uses_multiprocessing=False), (4, 0, 0))
+        self.assertEqual(BatchTestingBackend.batches, [3, 1])
+
+    @override_settings(POST_OFFICE=dict(
+        settings.POST_OFFICE, SEND_MESSAGES_BATCH_SIZE={'batch_tester': 2},
+        BACKENDS=dict(settings.POST_OFFICE['BACKENDS'],
+                      batch_tester='post_office.tests.test_mail.BatchTestingBackend'),
+    ))
+    def test_send_bulk_with_uncaught_error(self):
+        """
+        Ensure a batch raising an uncaught exception fails each of its emails,
+        instead of blocking the sender.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='accept', message='Message', status=STATUS.queued,
+                                 backend_alias='batch_tester')
+            for _ in range(2)
+        ]
+        with patch('post_office.mail._send_messages', side_effect=RuntimeError('Crashed')):
+            self.assertEqual(_send_bulk(emails, uses_multiprocessing=False), (0, 0, 2))
+        self.assertEqual(Email.objects.filter(status=STATUS.requeued).count(), 2)
+        self.assertEqual(Log.objects.filter(status=STATUS.failed, message='Crashed').count(), 2)
+
     def test_get_batch_size(self):
         """
         Ensure BATCH_SIZE setting is read correctly.
@@ -233,6 +570,118 @@ class MailTest(TestCase):
         send_many(kwargs_list)
         self.assertEqual(Email.objects.filter(to=['a@example.com']).count(), 1)
 
+    def test_send_many_with_invalid_rows(self):
+        """
+        Ensure send_many reports the errors of all invalid rows.
+        """
+        kwargs_list = [
+            {'sender': 'from@example.com', 'recipients': ['a@example.com']},
+            {'sender': 'from@example.com', 'recipients': ['invalid']},
+            {'sender': 'from@example.com', 'recipients': ['c@example.com'], 'priority': 'urgent'},
+        ]
+        with self.assertRaises(ValidationError) as context:
+            send_many(kwargs_list)
+        self.assertEqual(sorted(context.exception.message_dict), [1, 2])
+        self.assertEqual(Email.objects.count(), 0)
+
+        result = send_many(kwargs_list, skip_invalid=True)
+        self.assertEqual(result.queued, 1)
+        self.assertEqual(sorted(result.errors), [1, 2])
+        self.assertEqual(result.errors[1], ['recipients: invalid is not a valid email address'])
+        self.assertEqual(list(Email.objects.values_list('to', flat=True)), [['a@example.com']])
+
+    def test_send_many_in_chunks(self):
+        """
+        Ensure send_many consumes generators chunk by chunk, with one
+        email_queued signal per chunk.
+        """
+        kwargs_list = (
+            {'sender': 'from@example.com', 'recipients': ['%s@example.com' % i]}
+            for i in range(5)
+        )
+        chunks = []
+
+        def receiver(sender, emails, **kwargs):
+            chunks.append(len(emails))
+
+        email_queued.connect(receiver)
+        try:
+            result = send_many(kwargs_list, batch_size=2)
+        finally:
+            email_queued.disconnect(receiver)
+        self.assertEqual(result, (5, {}))
+        self.assertEqual(chunks, [2, 2, 1])
+        self.assertEqual(Email.objects.count(), 5)
+
+        # Chunks before the one holding an invalid row are queued
+        kwargs_list = [
+            {'sender': 'from@example.com', 'recipients': ['a@example.com']},
+            {'sender': 'from@example.com', 'recipients': ['b@example.com']},
+            {'sender': 'from@example.com', 'recipients': ['invalid']},
+        ]
+        with self.assertRaises(SendManyError) as context:
+            send_many(kwargs_list, batch_size=2)
+        self.assertEqual(list(context.exception.message_dict), [2])
+        self.assertEqual(context.exception.num_queued, 2)
+        self.assertEqual(Email.objects.count(), 7)
+
+    def test_send_many_with_attachments(self):
+        """
+        Ensure send_many creates shared attachments once.
+        """
+        shared = ContentFile('shared')
+        kwargs_list = [
+            {'sender': 'from@example.com', 'recipients': ['%s@example.com' % i],
+             'attachments': {'shared.txt': shared, 'own.txt': ContentFile(str(i))}}
+            for i in range(3)
+        ]
+        send_many(kwargs_list, batch_size=2)
+        self.assertEqual(Attachment.objects.count(), 4)
+        self.assertEqual(Attachment.objects.get(name='shared.txt').emails.count(), 3)
+        for email in Email.objects.all():
+            self.assertEqual(sorted(email.attachments.values_list('name', flat=True)),
+                             ['own.txt', 'shared.txt'])
+
+        # Rows passing the same file in the dict form share it too, unless
+        # its mimetype or headers differ
+        Attachment.objects.all().delete()
+        shared = ContentFile('shared')
+        kwargs_list = [
+            {'sender': 'from@example.com', 'recipients': ['%s@example.com' % i],
+             'attachments': {'shared.txt': {'file': shared, 'mimetype': 'text/plain'},
+                             'other.txt': {'file': shared, 'headers': {'X-Row': str(i % 2)}}}}
+            for i in range(4)
+        ]
+        send_many(kwargs_list, batch_size=3)
+        self.assertEqual(Attachment.objects.filter(name='shared.txt').count(), 1)
+        self.assertEqual(Attachment.objects.filter(name='other.txt').count(), 2)
+
+    def test_send_many_with_priority_now(self):
+        """
+        Ensure send_many sends emails with priority = 'now' once inserted.
+        """
+        kwargs_list = [
+            {'sender': 'from@example.com', 'recipients': ['a@example.com'],
+             'priority': 'now', 'backend': 'locmem',
+             'attachments': {'file.txt': ContentFile('content')}},
+            {'sender': 'from@example.com', 'recipients': ['b@example.com'], 'backend': 'locmem'},
+        ]
+        result = send_many(kwargs_list)
+        self.assertEqual(result.queued, 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['a@example.com'])
+        self.assertEqual(len(mail.outbox[0].attachments), 1)
+        self.assertEqual(Email.objects.get(to=['a@example.com']).status, STATUS.sent)
+        self.assertEqual(Email.objects.get(to=['b@example.com']).status, STATUS.queued)
+
+        # Until dispatched, they aren't in the queue
+        Email.objects.all().delete()
+        with patch('post_office.mail._send_bulk') as send_bulk:
+            send_many(kwargs_list)
+        self.assertEqual(send_bulk.call_count, 1)
+        self.assertIsNone(Email.objects.get(to=['a@example.com']).status)
+        self.assertEqual([email.to for email in get_queued()], [['b@example.com']])
+
     def test_send_with_attachments(self):
         attachments = {
             'attachment_file1.txt': ContentFile('content'),
@@ -0,0 +1,213 @@
+import smtplib
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends import locmem
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..backends import BatchSendError, SMTPEmailBackend
+from ..mail import _send_bulk, claim_queued
+from ..merging import get_message_digest, get_original_errors, merge_identical_messages
+from ..models import Email, Log, STATUS
+
+
+class RefusingBackend(locmem.EmailBackend):
+    """
+    A locmem backend reporting recipients starting with "refused" as refused.
+    """
+    reports_refused_recipients = True
+
+    def send_messages(self, messages):
+        num_sent = super().send_messages(messages)
+        refused = {}
+        for index, message in enumerate(messages):
+            recipients = {recipient: (550, b'No such user') for recipient in message.recipients()
+                          if recipient.startswith('refused')}
+            if recipients:
+                refused[index] = recipients
+        if refused:
+            raise BatchSendError({}, refused)
+        return num_sent
+
+
+class FakeSMTP:
+    """
+    An SMTP connection refusing recipients starting with "bad".
+    """
+    sent = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if any(address.startswith('bad') for address in to_addrs):
+            raise smtplib.SMTPRecipientsRefused({address: (550, b'No such user')
+                                                 for address in to_addrs})
+        self.sent.extend(to_addrs)
+        return {}
+
+    def quit(self):
+        pass
+
+
+@override_settings(POST_OFFICE=dict(
+    settings.POST_OFFICE, MERGE_IDENTICAL_MESSAGES=True, PREPARATION_WINDOW=10,
+    SEND_MESSAGES_BATCH_SIZE={'locmem': 10, 'refusing': 10, 'smtp_reporting': 10},
+    BACKENDS=dict(settings.POST_OFFICE['BACKENDS'],
+                  refusing='post_office.tests.test_merging.RefusingBackend',
+                  smtp_reporting='post_office.backends.SMTPEmailBackend'),
+))
+class MergingTest(TestCase):
+
+    def test_get_message_digest(self):
+        message = EmailMessage('Subject', 'Body', 'from@example.com', ['a@example.com'],
+                               headers={'Message-ID': '<1@example.com>', 'X-Campaign': '1'})
+        other = EmailMessage('Subject', 'Body', 'from@example.com', ['b@example.com'],
+                             headers={'Message-ID': '<2@example.com>', 'X-Campaign': '1'})
+        self.assertEqual(get_message_digest(message), get_message_digest(other))
+
+        other.extra_headers['X-Campaign'] = '2'
+        self.assertNotEqual(get_message_digest(message), get_message_digest(other))
+        other = EmailMessage('Subject', 'Body', 'from@example.com', ['b@example.com'],
+                             cc=['c@example.com'])
+        self.assertNotEqual(get_message_digest(message), get_message_digest(other))
+        other = EmailMessage('Subject', 'Body', 'from@example.com', ['b@example.com'])
+        other.attach('file.txt', 'content', 'text/plain')
+        self.assertNotEqual(get_message_digest(message), get_message_digest(other))
+
+    def test_merge_identical_messages(self):
+        messages = [
+            EmailMessage('Subject', 'Body', 'from@example.com', [recipient])
+            for recipient in ['a@example.com', 'b@example.com', 'c@example.com']
+        ]
+        messages.insert(1, EmailMessage('Other', 'Body', 'from@example.com', ['d@example.com']))
+        merged, indexes = merge_identical_messages(messages, max_recipients=2)
+        self.assertEqual(indexes, [[0, 2], [3], [1]])
+        self.assertEqual(merged[0].to, [])
+        self.assertEqual(merged[0].bcc, ['a@example.com', 'b@example.com'])
+        self.assertEqual(merged[0].recipients(), ['a@example.com', 'b@example.com'])
+        self.assertEqual(merged[0].message()['To'], 'undisclosed-recipients:;')
+        self.assertIs(merged[1], messages[3])
+        self.assertIs(merged[2], messages[1])
+        # Original messages are left untouched
+        self.assertEqual(messages[0].to, ['a@example.com'])
+        self.assertEqual(messages[0].extra_headers, {})
+
+        error = Exception()
+        self.assertEqual(get_original_errors({0: error}, indexes), [error, None, error, None])
+
+        # Only the messages of refused recipients fail
+        exceptions = get_original_errors({}, indexes, {0: {'B@example.com': (550, b'Refused')}},
+                                         messages)
+        self.assertEqual(exceptions[0], None)
+        self.assertIsInstance(exceptions[2], smtplib.SMTPRecipientsRefused)
+        self.assertEqual(exceptions[2].recipients, {'b@example.com': (550, b'Refused')})
+
+    def create_emails(self, recipients, backend_alias):
+        emails = [
+            Email.objects.create(to=[recipient], from_email='bob@example.com',
+                                 subject='Newsletter', message='Message', status=STATUS.queued,
+                                 backend_alias=backend_alias, message_id='<%s>' % recipient)
+            for recipient in recipients
+        ]
+        emails.append(Email.objects.create(to=['d@example.com'], from_email='bob@example.com',
+                                           subject='Other', message='Message',
+                                           status=STATUS.queued, backend_alias=backend_alias))
+        return emails
+
+    def test_send_bulk(self):
+        emails = self.create_emails(['a@example.com', 'refused@example.com', 'c@example.com'],
+                                    'refusing')
+        sent, failed, requeued = _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual((sent, failed, requeued), (3, 0, 1))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].recipients(),
+                         ['a@example.com', 'refused@example.com', 'c@example.com'])
+        self.assertEqual(mail.outbox[1].recipients(), ['d@example.com'])
+
+        for email in emails:
+            email.refresh_from_db()
+        self.assertEqual([email.status for email in emails],
+                         [STATUS.sent, STATUS.requeued, STATUS.sent, STATUS.sent])
+        self.assertEqual(Log.objects.get(status=STATUS.failed).email, emails[1])
+        # Merged emails record the Message-ID they were sent with
+        self.assertEqual(emails[2].message_id, emails[0].message_id)
+        self.assertEqual(mail.outbox[0].extra_headers['Message-ID'], emails[0].message_id)
+        self.assertNotEqual(emails[1].message_id, emails[0].message_id)
+
+    def test_send_bulk_with_claim(self):
+        """
+        Merged emails record their Message-ID while still leased.
+        """
+        self.create_emails(['a@example.com', 'b@example.com'], 'refusing')
+        with override_settings(POST_OFFICE=dict(settings.POST_OFFICE, CLAIM_ENABLED=True)):
+            emails = list(claim_queued(lease_owner='worker-1'))
+            self.assertEqual(_send_bulk(emails, uses_multiprocessing=False), (3, 0, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        merged = Email.objects.filter(subject='Newsletter')
+        self.assertEqual(set(merged.values_list('status', flat=True)), {STATUS.sent})
+        self.assertEqual(len(set(merged.values_list('message_id', flat=True))), 1)
+        self.assertEqual(merged.first().message_id, mail.outbox[0].extra_headers['Message-ID'])
+
+    def test_send_bulk_without_refused_recipients(self):
+        """
+        Messages aren't merged for backends which don't report refused recipients.
+        """
+        emails = self.create_emails(['a@example.com', 'b@example.com'], 'locmem')
+        self.assertEqual(_send_bulk(emails, uses_multiprocessing=False), (3, 0, 0))
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_smtp_backend_reports_refused_recipients(self):
+        backend = SMTPEmailBackend()
+        backend.connection = smtplib.SMTP()
+        messages = [
+            EmailMessage('Subject', 'Body', 'from@example.com', recipients)
+            for recipients in [['a@example.com'], ['a@example.com', 'b@example.com']]
+        ]
+        with patch.object(smtplib.SMTP, 'sendmail',
+                          side_effect=[{}, {'b@example.com': (550, b'Refused')}]) as sendmail:
+            with self.assertRaises(BatchSendError) as context:
+                backend.send_messages(messages)
+        self.assertEqual(context.exception.errors, {})
+        self.assertEqual(context.exception.refused, {1: {'b@example.com': (550, b'Refused')}})
+        self.assertEqual(sendmail.call_count, 2)
+
+    def test_smtp_backend_reports_failed_messages(self):
+        """
+        A message failing in the middle of a batch doesn't fail the others.
+        """
+        backend = SMTPEmailBackend()
+        backend.connection = smtplib.SMTP()
+        messages = [
+            EmailMessage('Subject', 'Body', 'from@example.com', [recipient])
+            for recipient in ['a@example.com', 'bad@example.com', 'c@example.com']
+        ]
+        error = smtplib.SMTPRecipientsRefused({'bad@example.com': (550, b'Refused')})
+        with patch.object(smtplib.SMTP, 'sendmail', side_effect=[{}, error, {}]) as sendmail:
+            with self.assertRaises(BatchSendError) as context:
+                backend.send_messages(messages)
+        self.assertEqual(context.exception.errors, {1: error})
+        self.assertEqual(context.exception.refused, {})
+        self.assertEqual(sendmail.call_count, 3)
+
+    def test_send_bulk_with_failed_smtp_message(self):
+        """
+        Only the email whose message failed in the middle of a batch is retried.
+        """
+        emails = [
+            Email.objects.create(to=[recipient], from_email='bob@example.com',
+                                 subject=recipient, message='Message', status=STATUS.queued,
+                                 backend_alias='smtp_reporting')
+            for recipient in ['a@example.com', 'bad@example.com', 'c@example.com']
+        ]
+        FakeSMTP.sent = []
+        with patch.object(SMTPEmailBackend, 'connection_class', FakeSMTP):
+            self.assertEqual(_send_bulk(emails, uses_multiprocessing=False), (2, 0, 1))
+        self.assertEqual(FakeSMTP.sent, ['a@example.com', 'c@example.com'])
+        for email in emails:
+            email.refresh_from_db()
+        self.assertEqual([email.status for email in emails],
+                         [STATUS.sent, STATUS.requeued, STATUS.sent])
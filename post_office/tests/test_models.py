@@ -11,6 +11,7 @@ from django.core.files.base import ContentFile
 from django.core.mail import EmailMessage, EmailMultiAlternatives
 from django.forms.models import modelform_factory
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 
 from ..models import Email, Log, PRIORITY, STATUS, EmailTemplate, Attachment
@@ -310,6 +311,67 @@ class ModelTest(TestCase):
         self.assertEqual(message.attachments,
                          [('test.txt', 'test file content', 'text/plain')])
 
+    def test_attachments_email_message_with_mime_parts(self):
+        """
+        Ensure attachments shared by emails prepared together are encoded once.
+        """
+        attachment = Attachment()
+        attachment.file.save('test.pdf', content=ContentFile(b'%PDF'), save=True)
+        emails = []
+        for recipient in ['a@example.com', 'b@example.com']:
+            email = Email.objects.create(to=[recipient], from_email='from@example.com',
+                                         subject='Subject')
+            email.attachments.add(attachment)
+            emails.append(email)
+
+        mime_parts = {}
+        messages = [email.prepare_email_message(mime_parts=mime_parts) for email in emails]
+        self.assertEqual(list(mime_parts), [attachment.id])
+        self.assertIs(messages[0].attachments[0], messages[1].attachments[0])
+        self.assertIs(messages[1].attachments[0], mime_parts[attachment.id])
+        self.assertIn(b'filename="test.pdf"', messages[1].message().as_bytes())
+        self.assertIn(b'JVBERg==', messages[1].message().as_bytes())
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, LARGE_ATTACHMENT_SIZE=100))
+    def test_large_attachments_email_message(self):
+        """
+        Ensure large attachments are encoded chunk by chunk.
+        """
+        email = Email.objects.create(to=['to@example.com'],
+                                     from_email='from@example.com',
+                                     subject='Subject')
+        content = bytes(range(256)) * 500
+        for name in ['small.txt', 'large.bin']:
+            attachment = Attachment()
+            attachment.file.save(name, content=ContentFile(content if name == 'large.bin' else b'small'),
+                                 save=True)
+            email.attachments.add(attachment)
+        message = email.email_message()
+
+        self.assertEqual(message.attachments[0], ('small.txt', 'small', 'text/plain'))
+        mime_part = message.attachments[1]
+        self.assertEqual(mime_part.get_content_type(), 'application/octet-stream')
+        self.assertEqual(mime_part.get_filename(), 'large.bin')
+        self.assertEqual(mime_part.get_payload(decode=True), content)
+        self.assertTrue(all(len(line) <= 76 for line in mime_part.get_payload().splitlines()))
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, LARGE_ATTACHMENT_SIZE=100))
+    def test_large_text_attachments_email_message(self):
+        """
+        Ensure large text attachments are handled by Django, keeping their charset.
+        """
+        email = Email.objects.create(to=['to@example.com'],
+                                     from_email='from@example.com',
+                                     subject='Subject')
+        content = 'Montant;Médaille\n'.encode('utf-8') * 20
+        attachment = Attachment(mimetype='text/csv')
+        attachment.file.save('report.csv', content=ContentFile(content), save=True)
+        email.attachments.add(attachment)
+        message = email.email_message()
+
+        self.assertEqual(message.attachments[0][0], 'report.csv')
+        self.assertIn(b'charset="utf-8"', message.message().as_bytes())
+
     def test_translated_template_uses_default_templates_name(self):
         template = EmailTemplate.objects.create(name='name')
         id_template = template.translated_templates.create(language='id')
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core import mail
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ..mail import _send_bulk
+from ..models import Email, STATUS
+from ..ratelimit import _local_counters, get_domains, get_rate_limiter, parse_rate, RateLimiter
+
+
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        _local_counters.clear()
+        caches['post_office'].clear()
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('100/s'), (100, 1))
+        self.assertEqual(parse_rate('10/m'), (10, 60))
+        self.assertEqual(parse_rate('5/hour'), (5, 3600))
+        self.assertRaises(ValueError, parse_rate, '100')
+        self.assertRaises(ValueError, parse_rate, '100/y')
+
+    def test_get_domains(self):
+        email = Email(to=['Alice <alice@Example.com>'], cc=['bob@example.org'], bcc=[])
+        self.assertEqual(get_domains(email), {'example.com', 'example.org'})
+
+    def test_rate_limiter(self):
+        for cache in (None, caches['post_office'], DummyCache('dummy', {})):
+            _local_counters.clear()
+            limiter = RateLimiter({'locmem': '2/h'}, {'example.org': '1/h', '*': '3/h'}, cache)
+            email = Email(to=['to@example.com'], backend_alias='locmem')
+            other_email = Email(to=['to@example.com'], backend_alias='default')
+            self.assertIsNone(limiter.acquire(email))
+            self.assertIsNone(limiter.acquire(email))
+            # Deferred to the next window, without counting against the domain limit
+            retry_at = limiter.acquire(email)
+            self.assertGreater(retry_at, timezone.now())
+            self.assertIsNone(limiter.acquire(other_email))
+            self.assertIsNotNone(limiter.acquire(other_email))
+
+            email = Email(to=['to@example.org'], backend_alias='default')
+            self.assertIsNone(limiter.acquire(email))
+            self.assertIsNotNone(limiter.acquire(email))
+
+    def test_get_rate_limiter(self):
+        self.assertIsNone(get_rate_limiter())
+        with self.settings(POST_OFFICE=dict(settings.POST_OFFICE, DOMAIN_RATE_LIMITS={'*': '1/s'})):
+            self.assertIsInstance(get_rate_limiter(), RateLimiter)
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, DOMAIN_RATE_LIMITS={'example.com': '2/h'}))
+    def test_send_bulk_defers_emails(self):
+        emails = [
+            Email.objects.create(to=['to@%s' % domain], from_email='bob@example.com',
+                                 subject='limit', message='Message', status=STATUS.queued,
+                                 backend_alias='locmem')
+            for domain in ['example.com', 'example.com', 'example.com', 'example.org']
+        ]
+        self.assertEqual(_send_bulk(emails, uses_multiprocessing=False), (3, 0, 0))
+        self.assertEqual(len(mail.outbox), 3)
+
+        deferred = Email.objects.get(id=emails[2].id)
+        self.assertEqual(deferred.status, STATUS.queued)
+        self.assertGreater(deferred.scheduled_time, timezone.now())
+        self.assertIsNone(deferred.number_of_retries)
@@ -0,0 +1,102 @@
+import smtplib
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ..mail import _send_bulk
+from ..models import Email, Log, STATUS
+from ..retry import get_retry_policy, get_smtp_codes, RetryPolicy
+
+
+class NeverRetryPolicy(RetryPolicy):
+
+    def get_retry_time(self, email, exception, now=None):
+        return None
+
+
+class RetryPolicyTest(TestCase):
+
+    def test_get_smtp_codes(self):
+        self.assertEqual(get_smtp_codes(smtplib.SMTPDataError(554, 'Rejected')), [554])
+        exception = smtplib.SMTPRecipientsRefused({'a@example.com': (550, 'No'),
+                                                   'b@example.com': (450, 'Busy')})
+        self.assertEqual(sorted(get_smtp_codes(exception)), [450, 550])
+        self.assertEqual(get_smtp_codes(ValueError()), [])
+
+    def test_default_policy(self):
+        """
+        Ensure the default policy retries every failure after RETRY_INTERVAL.
+        """
+        policy = get_retry_policy()
+        now = timezone.now()
+        email = Email(number_of_retries=None)
+        exception = smtplib.SMTPDataError(554, 'Rejected')
+        self.assertEqual(policy.get_retry_time(email, exception, now), now + timedelta(minutes=15))
+        email.number_of_retries = 1
+        self.assertEqual(policy.get_retry_time(email, exception, now), now + timedelta(minutes=15))
+        email.number_of_retries = 2
+        self.assertIsNone(policy.get_retry_time(email, exception, now))
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, MAX_RETRIES=10, RETRY_BACKOFF=2,
+                                        RETRY_INTERVAL=timedelta(minutes=1),
+                                        MAX_RETRY_INTERVAL=timedelta(minutes=5)))
+    def test_backoff(self):
+        policy = get_retry_policy()
+        delays = [policy.get_delay(retries) for retries in range(5)]
+        self.assertEqual(delays, [timedelta(minutes=minutes) for minutes in (1, 2, 4, 5, 5)])
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, RETRY_JITTER=0.5,
+                                        RETRY_INTERVAL=timedelta(minutes=10)))
+    def test_jitter(self):
+        policy = get_retry_policy()
+        delays = {policy.get_delay(0) for i in range(20)}
+        self.assertGreater(len(delays), 1)
+        for delay in delays:
+            self.assertTrue(timedelta(minutes=5) <= delay <= timedelta(minutes=10))
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE,
+                                        PERMANENT_ERRORS=[550, 554, 'SMTPSenderRefused']))
+    def test_permanent_errors(self):
+        policy = get_retry_policy()
+        self.assertTrue(policy.is_permanent(smtplib.SMTPDataError(554, 'Rejected')))
+        self.assertFalse(policy.is_permanent(smtplib.SMTPDataError(451, 'Try again later')))
+        self.assertTrue(policy.is_permanent(smtplib.SMTPSenderRefused(553, 'No', 'a@example.com')))
+        self.assertTrue(policy.is_permanent(
+            smtplib.SMTPRecipientsRefused({'a@example.com': (550, 'No')})))
+        # Only permanent if all recipients were refused permanently
+        self.assertFalse(policy.is_permanent(smtplib.SMTPRecipientsRefused(
+            {'a@example.com': (550, 'No'), 'b@example.com': (450, 'Busy')})))
+        self.assertFalse(policy.is_permanent(TimeoutError()))
+        self.assertIsNone(policy.get_retry_time(Email(), smtplib.SMTPDataError(550, 'No')))
+
+    def test_send_bulk(self):
+        """
+        Ensure the retry policy is applied to each failed email.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='bob@example.com',
+                                 subject='Test', message='Message', status=STATUS.queued,
+                                 backend_alias='error', number_of_retries=retries)
+            for retries in (None, 1, 2)
+        ]
+        with override_settings(POST_OFFICE=dict(settings.POST_OFFICE, MAX_RETRIES=5,
+                                                RETRY_BACKOFF=3)):
+            sent, failed, requeued = _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual((sent, failed, requeued), (0, 0, 3))
+        now = timezone.now()
+        for email, minutes in zip(emails, (15, 45, 135)):
+            email.refresh_from_db()
+            self.assertEqual(email.status, STATUS.requeued)
+            self.assertAlmostEqual(email.scheduled_time, now + timedelta(minutes=minutes),
+                                   delta=timedelta(seconds=10))
+        self.assertEqual([email.number_of_retries for email in emails], [1, 2, 3])
+
+        with override_settings(POST_OFFICE=dict(
+                settings.POST_OFFICE, RETRY_POLICY='post_office.tests.test_retry.NeverRetryPolicy')):
+            sent, failed, requeued = _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual((sent, failed, requeued), (0, 3, 0))
+        self.assertEqual(Log.objects.filter(status=STATUS.failed).count(), 6)
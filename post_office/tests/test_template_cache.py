@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.template import Context, Engine
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ..models import EmailTemplate
+from ..settings import get_template_engine
+from ..template.cache import CompiledTemplateCache
+
+
+class CompiledTemplateCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = CompiledTemplateCache()
+        self.template = EmailTemplate(pk=1, subject='Hi {{ name }}', content='Content {{ name }}',
+                                      html_content='<p>{{ name }}</p>', last_updated=timezone.now())
+
+    def test_get(self):
+        engine = get_template_engine()
+        subject, content, html_content = self.cache.get(self.template, engine)
+        self.assertEqual(subject.render({'name': 'Alice'}), 'Hi Alice')
+        self.assertEqual(content.render({'name': 'Alice'}), 'Content Alice')
+        self.assertEqual(html_content.render({'name': 'Alice'}), '<p>Alice</p>')
+        self.assertEqual(self.cache.info()[:2], (0, 1))
+
+        self.assertIs(self.cache.get(self.template, engine)[0], subject)
+        self.assertEqual(self.cache.info()[:2], (1, 1))
+
+        # Templates compiled by another engine are cached separately
+        subject = self.cache.get(self.template, Engine.get_default())[0]
+        self.assertEqual(subject.render(Context({'name': 'Bob'})), 'Hi Bob')
+        self.assertEqual(self.cache.info().currsize, 2)
+
+    def test_modified_template(self):
+        engine = get_template_engine()
+        self.cache.get(self.template, engine)
+        self.template.subject = 'Hello {{ name }}'
+        self.template.last_updated = timezone.now()
+        subject = self.cache.get(self.template, engine)[0]
+        self.assertEqual(subject.render({'name': 'Alice'}), 'Hello Alice')
+        self.assertEqual(self.cache.info()[:2], (0, 2))
+
+    def test_unsaved_template(self):
+        self.template.pk = None
+        self.cache.get(self.template, get_template_engine())
+        self.assertEqual(self.cache.info(), (0, 0, 128, 0))
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, COMPILED_TEMPLATE_CACHE_SIZE=1))
+    def test_eviction(self):
+        engine = get_template_engine()
+        other_template = EmailTemplate(pk=2, subject='Other', last_updated=timezone.now())
+        self.cache.get(self.template, engine)
+        self.cache.get(other_template, engine)
+        self.assertEqual(self.cache.info().currsize, 1)
+        self.cache.get(self.template, engine)
+        self.assertEqual(self.cache.info()[:2], (0, 3))
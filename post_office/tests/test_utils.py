@@ -1,13 +1,23 @@
+import hashlib
+
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.exceptions import ValidationError
 
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils import timezone
 
-from ..models import Email, STATUS, PRIORITY, EmailTemplate, Attachment
-from ..utils import (create_attachments, get_email_template, parse_emails,
+from ..mail import archive_delivered
+from ..models import (ArchivedEmail, ArchivedLog, Email, Log, STATUS, PRIORITY, EmailTemplate,
+                      Attachment)
+from ..utils import (archive_emails, create_attachments, get_email_template, parse_emails,
                      parse_priority, send_mail, split_emails)
-from ..validators import validate_email_with_name, validate_comma_separated_emails
+from ..validators import (validate_email_with_name, validate_comma_separated_emails,
+                          _validate_email_with_name)
 
 
 @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
@@ -43,6 +53,17 @@ class UtilsTest(TestCase):
         self.assertRaises(ValidationError, validate_email_with_name, 'Al <ab>')
         self.assertRaises(ValidationError, validate_email_with_name, 'Al <>')
 
+    def test_email_validator_memoization(self):
+        _validate_email_with_name.cache_clear()
+        for i in range(3):
+            validate_email_with_name('Alice <alice@example.com>')
+        self.assertEqual(_validate_email_with_name.cache_info().hits, 2)
+
+        # Invalid addresses are not memoized
+        for i in range(2):
+            self.assertRaises(ValidationError, validate_email_with_name, 'invalid')
+        self.assertEqual(_validate_email_with_name.cache_info().currsize, 1)
+
     def test_comma_separated_email_list_validator(self):
         # These should validate
         validate_comma_separated_emails(['email@example.com'])
@@ -177,6 +198,44 @@ class UtilsTest(TestCase):
         self.assertEquals(attachments[0].name, 'attachment_file.py')
         self.assertEquals(attachments[0].mimetype, '')
 
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, ATTACHMENT_DEDUPLICATION=True))
+    def test_create_attachments_deduplicated(self):
+        first, = create_attachments({'brochure.pdf': ContentFile('content')})
+        second, = create_attachments({'brochure.pdf': ContentFile('content')})
+        renamed, = create_attachments({'offer.pdf': ContentFile('content')})
+        other, = create_attachments({'brochure.pdf': ContentFile('other content')})
+
+        # Identical attachments are created once, identical content is stored once
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, renamed)
+        self.assertEqual(first.file.name, renamed.file.name)
+        self.assertNotEqual(first.file.name, other.file.name)
+        self.assertEqual(first.digest, hashlib.sha256(b'content').hexdigest())
+        self.assertEqual(renamed.name, 'offer.pdf')
+        self.assertEqual(renamed.file.read(), b'content')
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, ATTACHMENT_DEDUPLICATION=True))
+    def test_create_attachments_deduplicated_file_deleted(self):
+        """
+        A file deleted by cleanup after being found by a new attachment is
+        stored again once the attachment is committed.
+        """
+        first, = create_attachments({'brochure.pdf': ContentFile('content')})
+        storage = first.file.storage
+        exists = storage.exists
+
+        def delete_after_check(name):
+            result = exists(name)
+            storage.delete(name)
+            return result
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with patch.object(storage, 'exists', side_effect=delete_after_check):
+                renamed, = create_attachments({'offer.pdf': ContentFile('content')})
+        self.assertEqual(renamed.file.name, first.file.name)
+        self.assertTrue(storage.exists(renamed.file.name))
+        self.assertEqual(renamed.file.read(), b'content')
+
     def test_parse_priority(self):
         self.assertEqual(parse_priority('now'), PRIORITY.now)
         self.assertEqual(parse_priority('high'), PRIORITY.high)
@@ -202,3 +261,64 @@ class UtilsTest(TestCase):
             ValidationError,
             parse_emails, ['invalid_email', 'test@example.com']
         )
+
+    def test_archive_emails(self):
+        template = EmailTemplate.objects.create(name='archived')
+        sent = Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                    subject='Sent', status=STATUS.sent, template=template,
+                                    context={'name': 'Alice'}, message_id='<1@example.com>')
+        failed = Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                      status=STATUS.failed)
+        queued = Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                      status=STATUS.queued)
+        attachment = Attachment(name='test.txt')
+        attachment.file.save('test.txt', content=ContentFile('test'), save=True)
+        attachment.emails.add(sent)
+        Log.objects.create(email=sent, status=STATUS.sent, message='')
+        Log.objects.create(email=failed, status=STATUS.failed, message='Error',
+                           exception_type='SMTPDataError')
+
+        # Only emails last updated before the cutoff date are archived
+        self.assertEqual(archive_emails(timezone.now() - timedelta(days=1)), 0)
+        self.assertEqual(archive_emails(timezone.now() + timedelta(seconds=1), batch_size=1), 2)
+
+        self.assertEqual(list(Email.objects.values_list('id', flat=True)), [queued.id])
+        self.assertEqual(Log.objects.count(), 0)
+        archived = ArchivedEmail.objects.get(id=sent.id)
+        self.assertEqual(archived.to, ['to@example.com'])
+        self.assertEqual(archived.subject, 'Sent')
+        self.assertEqual(archived.status, STATUS.sent)
+        self.assertEqual(archived.template, template)
+        self.assertEqual(archived.context, {'name': 'Alice'})
+        self.assertEqual(archived.message_id, '<1@example.com>')
+        self.assertEqual(archived.created, sent.created)
+        self.assertEqual(list(archived.attachments.all()), [attachment])
+        log = ArchivedLog.objects.get(email_id=failed.id)
+        self.assertEqual((log.status, log.exception_type), (STATUS.failed, 'SMTPDataError'))
+
+    def test_archive_emails_with_reused_ids(self):
+        """
+        Emails whose ID is already archived are left in place, without
+        preventing others from being archived.
+        """
+        emails = [
+            Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                 status=STATUS.sent)
+            for _ in range(3)
+        ]
+        ArchivedEmail.objects.create(id=emails[1].id, to=['old@example.com'],
+                                     from_email='from@example.com', status=STATUS.sent,
+                                     created=timezone.now(), last_updated=timezone.now())
+        with self.assertLogs('post_office', level='WARNING'):
+            self.assertEqual(archive_emails(timezone.now() + timedelta(seconds=1), batch_size=2), 2)
+        self.assertEqual(list(Email.objects.values_list('id', flat=True)), [emails[1].id])
+        self.assertEqual(ArchivedEmail.objects.get(id=emails[1].id).to, ['old@example.com'])
+
+    @override_settings(POST_OFFICE=dict(settings.POST_OFFICE, ARCHIVE_AFTER=timedelta(days=1)))
+    def test_archive_delivered_failure(self):
+        """
+        Archiving failures are logged instead of being raised.
+        """
+        with patch('post_office.mail.archive_emails', side_effect=Exception('Archive failed')):
+            with self.assertLogs('post_office', level='ERROR'):
+                self.assertEqual(archive_delivered(), 0)
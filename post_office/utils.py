@@ -1,13 +1,25 @@
+import hashlib
+
+from email.utils import parseaddr
+from functools import partial
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files import File
-from django.utils.encoding import force_str
+from django.db import connection as db_connection, transaction
+from django.utils.encoding import force_bytes, force_str
 
 from post_office import cache
-from .models import Email, PRIORITY, STATUS, EmailTemplate, Attachment
-from .settings import get_default_priority
+from .logutils import setup_loghandlers
+from .models import (
+    ArchivedEmail, ArchivedLog, Attachment, Email, EmailTemplate, Log, PRIORITY, STATUS,
+    get_digest_upload_path,
+)
+from .settings import get_attachment_dedup_enabled, get_default_priority
 from .validators import validate_email_with_name
 
+logger = setup_loghandlers("INFO")
+
 
 def send_mail(subject, message, from_email, recipient_list, html_message='',
               scheduled_time=None, headers=None, priority=PRIORITY.medium):
@@ -61,35 +73,78 @@ def split_emails(emails, split_count=1):
     return []
 
 
-def create_attachments(attachment_files):
+def get_recipient_domain(email):
     """
-    Create Attachment instances from files
+    Returns the domain of the first recipient of ``email``, in lowercase.
+    """
+    recipients = list(email.to or []) + list(email.cc or []) + list(email.bcc or [])
+    if not recipients:
+        return ''
+    return parseaddr(recipients[0])[1].rpartition('@')[2].lower()
 
-    attachment_files is a dict of:
-        * Key - the filename to be used for the attachment.
-        * Value - file-like object, or a filename to open OR a dict of {'file': file-like-object, 'mimetype': string}
 
-    Returns a list of Attachment objects
+def _get_domain_groups(emails, group_size):
+    buckets = {}
+    for email in emails:
+        key = (email.backend_alias or 'default', get_recipient_domain(email))
+        buckets.setdefault(key, []).append(email)
+
+    groups = []
+    buckets = list(buckets.values())
+    for start in range(0, max((len(bucket) for bucket in buckets), default=0), group_size):
+        for bucket in buckets:
+            if bucket[start:start + group_size]:
+                groups.append(bucket[start:start + group_size])
+    return groups
+
+
+def group_by_domain(emails, group_size):
+    """
+    Reorders emails so that those sent through the same backend to the same
+    recipient domain follow each other, by groups of at most ``group_size``.
+    Domains take turns, so that a large domain doesn't hold up the others.
     """
-    attachments = []
-    for filename, filedata in attachment_files.items():
+    return [email for group in _get_domain_groups(emails, group_size) for email in group]
 
-        if isinstance(filedata, dict):
-            content = filedata.get('file', None)
-            mimetype = filedata.get('mimetype', None)
-            headers = filedata.get('headers', None)
-        else:
-            content = filedata
-            mimetype = None
-            headers = None
 
-        opened_file = None
+def split_by_domain(emails, group_size, parts):
+    """
+    Splits emails into ``parts`` lists ordered like ``group_by_domain()``.
+    Groups are dealt in turn to the list holding the fewest emails, so that
+    domains take turns within each list as well as across them.
+    """
+    lists = [[] for _ in range(parts)]
+    for group in _get_domain_groups(emails, group_size):
+        min(lists, key=len).extend(group)
+    return [part for part in lists if part]
 
-        if isinstance(content, str):
-            # `content` is a filename - try to open the file
-            opened_file = open(content, 'rb')
-            content = File(opened_file)
 
+def create_attachment(filename, filedata):
+    """
+    Create an Attachment instance from a file
+
+    filedata is a file-like object, or a filename to open OR a dict of
+    {'file': file-like-object, 'mimetype': string, 'headers': dict}
+    """
+    if isinstance(filedata, dict):
+        content = filedata.get('file', None)
+        mimetype = filedata.get('mimetype', None)
+        headers = filedata.get('headers', None)
+    else:
+        content = filedata
+        mimetype = None
+        headers = None
+
+    opened_file = None
+
+    if isinstance(content, str):
+        # `content` is a filename - try to open the file
+        opened_file = open(content, 'rb')
+        content = File(opened_file)
+
+    if get_attachment_dedup_enabled():
+        attachment = _create_deduplicated_attachment(filename, content, mimetype, headers)
+    else:
         attachment = Attachment()
         if mimetype:
             attachment.mimetype = mimetype
@@ -97,12 +152,75 @@ def create_attachments(attachment_files):
         attachment.name = filename
         attachment.file.save(filename, content=content, save=True)
 
-        attachments.append(attachment)
+    if opened_file is not None:
+        opened_file.close()
 
-        if opened_file is not None:
-            opened_file.close()
+    return attachment
 
-    return attachments
+
+def _create_deduplicated_attachment(filename, content, mimetype, headers):
+    """
+    Stores content under its SHA-256 digest, unless identical content is
+    already stored, and reuses an existing attachment having the same
+    content, name, mimetype and headers.
+
+    The reused attachment is locked until the end of the transaction, which
+    should link it to its email, so that cleanup_mail can't delete it meanwhile.
+    """
+    if not isinstance(content, File):
+        content = File(content)
+    sha256 = hashlib.sha256()
+    for chunk in content.chunks():
+        sha256.update(force_bytes(chunk))
+    digest = sha256.hexdigest()
+
+    candidates = Attachment.objects.select_for_update() \
+        .filter(digest=digest, name=filename, mimetype=mimetype or '')
+    with transaction.atomic():
+        for attachment in candidates:
+            if attachment.headers == headers:
+                return attachment
+
+    attachment = Attachment(name=filename, headers=headers, digest=digest)
+    if mimetype:
+        attachment.mimetype = mimetype
+    path = get_digest_upload_path(digest, filename)
+    storage = attachment.file.storage
+    if storage.exists(path):
+        # cleanup_mail may delete the file once it found it unreferenced, before
+        # this attachment is committed, in which case it's stored again
+        transaction.on_commit(partial(_restore_file, storage, path, content))
+    else:
+        content.seek(0)
+        path = storage.save(path, content)
+    attachment.file.name = path
+    attachment.save()
+    return attachment
+
+
+def _restore_file(storage, path, content):
+    if not storage.exists(path):
+        closed = content.closed
+        content.open('rb')
+        try:
+            storage.save(path, content)
+        finally:
+            if closed:
+                content.close()
+
+
+def create_attachments(attachment_files):
+    """
+    Create Attachment instances from files
+
+    attachment_files is a dict of:
+        * Key - the filename to be used for the attachment.
+        * Value - file-like object, or a filename to open OR a dict of {'file': file-like-object, 'mimetype': string}
+
+    Returns a list of Attachment objects
+    """
+    return [create_attachment(filename, filedata)
+            for filename, filedata in attachment_files.items()]
 
 
 def parse_priority(priority):
@@ -142,27 +260,88 @@ def parse_emails(emails):
 
 def cleanup_expired_mails(cutoff_date, delete_attachments=True, batch_size=1000):
     """
-    Delete all emails before the given cutoff date.
+    Delete all emails before the given cutoff date, archived or not.
     Optionally also delete pending attachments.
     Return the number of deleted emails and attachments.
     """
-    expired_emails_ids = Email.objects.filter(created__lt=cutoff_date).values_list('id', flat=True)
-    email_id_batches = split_emails(expired_emails_ids, batch_size)
     total_deleted_emails = 0
-    
-    for email_ids in email_id_batches:
-        # Delete email and incr total_deleted_emails counter
-        _, deleted_data = Email.objects.filter(id__in=email_ids).delete()
-        if deleted_data:
-            total_deleted_emails += deleted_data['post_office.Email']
+    for model in (Email, ArchivedEmail):
+        expired_emails_ids = model.objects.filter(created__lt=cutoff_date).values_list('id', flat=True)
+        email_id_batches = split_emails(expired_emails_ids, batch_size)
+
+        for email_ids in email_id_batches:
+            # Delete email and incr total_deleted_emails counter
+            _, deleted_data = model.objects.filter(id__in=email_ids).delete()
+            if deleted_data:
+                total_deleted_emails += deleted_data[model._meta.label]
 
     if delete_attachments:
-        attachments = Attachment.objects.filter(emails=None)
-        for attachment in attachments:
-            # Delete the actual file
-            attachment.file.delete()
-        attachments_count, _ = attachments.delete()
+        orphans = Attachment.objects.filter(emails=None, archived_emails=None)
+        with transaction.atomic():
+            # Attachments being reused by a deduplicated attachment are locked
+            # until linked, and are no longer orphans once the lock is acquired
+            if db_connection.features.has_select_for_update_of:
+                locked = orphans.select_for_update(of=('self',))
+            else:
+                locked = orphans.select_for_update()
+            attachment_ids = list(locked.values_list('id', flat=True))
+            attachments = orphans.filter(id__in=attachment_ids)
+            file_names = set(attachments.values_list('file', flat=True))
+            attachments_count, _ = attachments.delete()
+        # Delete the actual files, unless deduplicated content is still referenced.
+        # References are checked right before each deletion, to narrow the
+        # window in which a new attachment could reuse the file.
+        storage = Attachment._meta.get_field('file').storage
+        for file_name in file_names - {""}:
+            if not Attachment.objects.filter(file=file_name).exists():
+                storage.delete(file_name)
     else:
         attachments_count = 0
 
     return total_deleted_emails, attachments_count
+
+
+def archive_emails(cutoff_date, batch_size=1000):
+    """
+    Moves sent and failed emails last updated before the given cutoff date,
+    along with their logs, to the archive tables, ``batch_size`` at a time.
+    Returns the number of archived emails.
+
+    Emails are locked while being archived, so that they can't be requeued
+    meanwhile. Emails whose ID is already archived, which happens when the
+    database reuses the IDs of deleted rows, are left in place.
+    """
+    fields = [field.attname for field in ArchivedEmail._meta.concrete_fields
+              if field.name != 'archived']
+    log_fields = ['email_id', 'date', 'status', 'exception_type', 'message']
+    queryset = Email.objects.filter(status__in=[STATUS.sent, STATUS.failed],
+                                    last_updated__lt=cutoff_date).order_by('id')
+    total_archived = 0
+    last_id = None
+
+    while True:
+        with transaction.atomic():
+            batch = queryset if last_id is None else queryset.filter(id__gt=last_id)
+            email_ids = list(batch.select_for_update().values_list('id', flat=True)[:batch_size])
+            if not email_ids:
+                break
+            last_id = email_ids[-1]
+            archived_ids = set(ArchivedEmail.objects.filter(id__in=email_ids)
+                               .values_list('id', flat=True))
+            if archived_ids:
+                logger.warning('Not archiving emails %s, whose IDs are already archived.',
+                               ', '.join(str(email_id) for email_id in sorted(archived_ids)))
+                email_ids = [email_id for email_id in email_ids if email_id not in archived_ids]
+            emails = Email.objects.filter(id__in=email_ids).values(*fields)
+            ArchivedEmail.objects.bulk_create([ArchivedEmail(**email) for email in emails])
+            logs = Log.objects.filter(email_id__in=email_ids).values(*log_fields)
+            ArchivedLog.objects.bulk_create([ArchivedLog(**log) for log in logs])
+            through_rows = Attachment.emails.through.objects.filter(email_id__in=email_ids)
+            ArchivedEmail.attachments.through.objects.bulk_create([
+                ArchivedEmail.attachments.through(archivedemail_id=email_id, attachment_id=attachment_id)
+                for email_id, attachment_id in through_rows.values_list('email_id', 'attachment_id')
+            ])
+            Email.objects.filter(id__in=email_ids).delete()
+        total_archived += len(email_ids)
+
+    return total_archived
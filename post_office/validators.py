@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
 from django.template import Template, TemplateSyntaxError, TemplateDoesNotExist
@@ -10,8 +12,13 @@ def validate_email_with_name(value):
 
     Both "Recipient Name <email@example.com>" and "email@example.com" are valid.
     """
-    value = force_str(value)
+    _validate_email_with_name(force_str(value))
+
 
+# Valid addresses are memoized, so that addresses appearing in many emails
+# (e.g. senders) are only validated once per process
+@lru_cache(maxsize=4096)
+def _validate_email_with_name(value):
     recipient = value
     if '<' in value and '>' in value:
         start = value.find('<') + 1